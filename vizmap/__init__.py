@@ -1 +1 @@
-from .vizmap import VizMap, basemaps
+from .vizmap import VizMap, LinkedMaps, basemaps
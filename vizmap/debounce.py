@@ -16,15 +16,18 @@ class Timer:
 def debounce(wait):
     """ Decorator that will postpone a function's
         execution until after `wait` seconds
-        have elapsed since the last time it was invoked. """
+        have elapsed since the last time it was invoked.
+        Calls are debounced per first argument, so for
+        methods every instance has its own timer. """
     def decorator(fn):
-        timer = None
+        timers = {}
         def debounced(*args, **kwargs):
-            nonlocal timer
+            key = id(args[0]) if args else None
             def call_it():
+                timers.pop(key, None)
                 fn(*args, **kwargs)
-            if timer is not None:
-                timer.cancel()
-            timer = Timer(wait, call_it)
+            if key in timers:
+                timers[key].cancel()
+            timers[key] = Timer(wait, call_it)
         return debounced
     return decorator
\ No newline at end of file
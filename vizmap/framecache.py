@@ -0,0 +1,63 @@
+import os
+import json
+import hashlib
+
+
+class FrameCache:
+    """
+    On-disk cache of rendered frames. Frames of a layer are stored as one
+    JSON file per frame, in a directory named after the hash of the layer's
+    parameters. Frames are written atomically, so an interrupted run leaves
+    no partial frames behind.
+    """
+    def __init__(self, directory, key):
+        """
+        Arguments:
+        directory (string): Directory the frame caches of all layers are
+            stored in.
+        key (string): Key identifying the layer parameters frames are
+            rendered with, see frame_cache_key.
+        """
+        self.path = os.path.join(directory,
+                                 hashlib.sha1(key.encode()).hexdigest()[:16])
+        os.makedirs(self.path, exist_ok=True)
+
+        key_path = os.path.join(self.path, 'key.json')
+        if not os.path.exists(key_path):
+            with open(key_path, 'w') as f:
+                f.write(key)
+
+    def frame_path(self, i):
+        return os.path.join(self.path, f"{i}.json")
+
+    def __contains__(self, i):
+        return os.path.exists(self.frame_path(i))
+
+    def get(self, i):
+        """
+        Returns frame i, or 0 if it is not cached.
+        """
+        try:
+            with open(self.frame_path(i)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def put(self, i, frame):
+        path = self.frame_path(i)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(frame, f)
+        os.replace(tmp, path)
+
+
+def frame_cache_key(file, files=(), **params):
+    """
+    Returns the key of the frame cache of a layer rendering the dataset file,
+    and variables from files, with the given parameters. The key changes when
+    any of the datasets is modified.
+    """
+    params['file'] = os.path.abspath(file)
+    params['files'] = [os.path.abspath(f) for f in files]
+    params['mtime'] = [os.path.getmtime(f) for f in (file,) + tuple(files)]
+    return json.dumps(params, sort_keys=True, default=str)
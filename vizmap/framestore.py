@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from collections import namedtuple
+
+
+# Reference to a frame within a frame store. Passed to render workers instead
+# of the frame data, so workers map the store themselves instead of receiving
+# a copy of the frame.
+FrameRef = namedtuple('FrameRef', ['path', 'frame'])
+
+_stores = {}
+
+
+def store_path(file, variable, stride=1, series=False, files=()):
+    """
+    Returns the path of the frame store of a variable, next to the dataset.
+    The path contains a hash of the variable name and the paths of all
+    datasets it may be read from, so expressions that only differ in their
+    operators, or variables from different files, get different stores.
+
+    Arguments:
+    file (string): Filename of dataset file.
+    variable (string): Name of variable within dataset file, or expression.
+    stride (int): Stride the variable is stored with.
+    series (boolean): If True, the path of the series store is returned.
+    files ([string]): Filenames of the other datasets variable may be read
+        from.
+    """
+    root = os.path.splitext(file)[0]
+    name = re.sub(r'[^\w.-]+', '_', variable)
+    sources = [os.path.abspath(f) for f in (file,) + tuple(files)]
+    digest = hashlib.sha1(json.dumps([variable] + sources).encode()).hexdigest()[:12]
+    suffix = f".s{stride}" if stride != 1 else ''
+    if series:
+        suffix += '.series'
+    return f"{root}.{name}.{digest}{suffix}.f32.npy"
+
+
+def sources_mtime(file, files=()):
+    """
+    Returns the time the most recently modified of file and files was
+    modified.
+    """
+    return max(os.path.getmtime(f) for f in (file,) + tuple(files))
+
+
+def convert_to_store(variable, path, stride=1):
+    """
+    Writes a variable to an uncompressed, frame-contiguous float32 file.
+    Frames are read one time chunk at a time so every compressed chunk is
+    decompressed only once. Missing values are stored as NaN.
+
+    Arguments:
+    variable ([time:y:x]): netCDF variable to be converted.
+    path (string): Filename of frame store.
+    stride (int): Using a stride of n means storing every nth value in both
+        spatial dimensions.
+    """
+    n = len(variable)
+    shape = variable[0, ::stride, ::stride].shape
+
+    chunking = variable.chunking() if hasattr(variable, 'chunking') else 'contiguous'
+    chunk = chunking[0] if chunking != 'contiguous' else 1
+
+    tmp = path + '.tmp'
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                    shape=(n,) + shape)
+    for start in range(0, n, chunk):
+        block = variable[start:start+chunk, ::stride, ::stride]
+        out[start:start+chunk] = np.ma.filled(np.ma.asarray(block, dtype=np.float32),
+                                              np.nan)
+    out.flush()
+    del out
+    os.replace(tmp, path)
+
+
+def convert_to_series_store(variable, path, stride=1, tile=64):
+    """
+    Writes a variable to an uncompressed float32 file with time as the
+    fastest varying dimension, [y:x:time], so the time series of a point or
+    small neighborhood is read in one contiguous run. Frames are read one
+    time chunk at a time and written transposed in tiles of rows.
+
+    Arguments:
+    variable ([time:y:x]): netCDF variable to be converted.
+    path (string): Filename of series store.
+    stride (int): Using a stride of n means storing every nth value in both
+        spatial dimensions.
+    tile (int): Number of rows transposed at once.
+    """
+    n = len(variable)
+    shape = variable[0, ::stride, ::stride].shape
+
+    chunking = variable.chunking() if hasattr(variable, 'chunking') else 'contiguous'
+    chunk = chunking[0] if chunking != 'contiguous' else 24
+
+    tmp = path + '.tmp'
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                    shape=shape + (n,))
+    for start in range(0, n, chunk):
+        block = variable[start:start+chunk, ::stride, ::stride]
+        block = np.ma.filled(np.ma.asarray(block, dtype=np.float32), np.nan)
+        for y in range(0, shape[0], tile):
+            out[y:y+tile, :, start:start+chunk] = block[:, y:y+tile].transpose(1, 2, 0)
+    out.flush()
+    del out
+    os.replace(tmp, path)
+
+
+def open_store(path):
+    """
+    Memory maps a frame store read-only. Stores are mapped once per process.
+    """
+    if path not in _stores:
+        _stores[path] = np.load(path, mmap_mode='r')
+    return _stores[path]
+
+
+def get_store(file, variable, name, stride=1, series=False, files=()):
+    """
+    Returns the memory mapped frame store of a variable, converting the
+    variable first if the store does not exist or is older than any of the
+    datasets.
+
+    Arguments:
+    file (string): Filename of dataset file.
+    variable ([time:y:x]): netCDF variable within dataset file.
+    name (string): Name of variable within dataset file.
+    stride (int): Stride the variable is stored with.
+    series (boolean): If True, the series store [y:x:time] is returned
+        instead, see convert_to_series_store.
+    files ([string]): Filenames of the other datasets variable may be read
+        from.
+    """
+    path = store_path(file, name, stride, series, files)
+    if not os.path.exists(path) or \
+            os.path.getmtime(path) < sources_mtime(file, files):
+        _stores.pop(path, None)
+        if series:
+            convert_to_series_store(variable, path, stride)
+        else:
+            convert_to_store(variable, path, stride)
+    return open_store(path)
+
+
+def load_frame(ref):
+    """
+    Returns the frame referenced by ref, without copying it.
+    """
+    return open_store(ref.path)[ref.frame]
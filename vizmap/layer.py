@@ -1,22 +1,178 @@
-import threading
 import numpy as np
 import netCDF4 as nc
 import gdal
-from multiprocessing import Pool, cpu_count
 from affine import Affine
 from ipyleaflet import *
 from ipywidgets import FloatSlider, IntSlider, Play, jslink, Box, Label
 
 from .selection import *
 from .processing import *
+from .framestore import *
+from .framecache import *
+from .regrid import *
+from .sources import *
+from .renderer import *
 from .debounce import *
 
 
 class Layer:
+    video = None            # (url, start, stop, fps) of encoded video
+    video_error = None      # Exception encoding the video failed with
+    video_playing = False   # Whether the video is shown instead of frames
+    series = None           # Series stores [y:x:time] of the layer variables
+    
     def read_time(self, time):
         self.time = nc.num2date(time[:], units=time.units,
                                 calendar=time.calendar)
         
+    def read_frames(self, variable, start, n):
+        """
+        Reads n frames of variable from start. If the layer reads from a frame
+        store, references to the frames are returned instead, so render
+        workers map the frames from the store themselves.
+        """
+        if self.memmap:
+            return [FrameRef(variable.filename, i) for i in range(start, start+n)]
+        s = self.read_stride
+        return variable[start:start+n, ::s, ::s]
+        
+    def is_cached(self, i):
+        return self.cache[i] != 0 or \
+            (self.frame_cache is not None and i in self.frame_cache)
+        
+    def get_cached(self, i):
+        """
+        Returns frame i from the cache, or 0 if it is not cached. Frames not
+        in memory are loaded from the frame cache directory, if any.
+        """
+        if self.cache[i] == 0 and self.frame_cache is not None:
+            self.cache[i] = self.frame_cache.get(i)
+        return self.cache[i]
+        
+    def set_cached(self, i, frame):
+        self.cache[i] = frame
+        if self.frame_cache is not None:
+            self.frame_cache.put(i, frame)
+        
+    def render_frame(self, i):
+        """
+        Renders frame i, or waits for it if the renderer is rendering it
+        already, e.g. for another layer with the same cache.
+        """
+        result = self.renderer.wait((self.key, i))
+        if result is None:
+            with self.renderer.lock:
+                args = self.render_args(i, 1)[0]
+            result = calc_frame(*args)
+        return result[0]
+        
+    def __len__(self):
+        return len(self.cache)
+        
+    def locate(self, lat, long):
+        """
+        Returns the row and column of the grid cell containing lat, long, or
+        None if it is outside the grid. On 2d grids the nearest cell is
+        returned, found with a KD-tree of the grid built on first use.
+        """
+        if self.transform is None:
+            if getattr(self, 'locator', None) is None:
+                self.locator = build_tree(*self.coords)
+            tree, reach = self.locator
+            d, i = tree.query(unit_vectors(lat, long)[0])
+            if d > reach:
+                return None
+            return tuple(int(x) for x in np.unravel_index(i, np.shape(self.coords[0])))
+        
+        col, row = ~self.transform * (long, lat)
+        row, col = int(np.floor(row)), int(np.floor(col))
+        if 0 <= row < len(self.coords[0]) and 0 <= col < len(self.coords[1]):
+            return row, col
+        return None
+        
+    def probe(self, lat, long, radius=0):
+        """
+        Returns the time series of the grid cell containing lat, long, or
+        None if it is outside the grid. Series are read from the series
+        stores of the layer if it has them, else from the dataset. For wind
+        layers, a tuple of the series of u and v is returned.
+        
+        Arguments:
+        lat (float): Latitude of point.
+        long (float): Longitude of point.
+        radius (int): If larger than 0, the series of the cells within radius
+            cells are returned, as [time:y:x].
+        """
+        cell = self.locate(lat, long)
+        if cell is None:
+            return None
+        rows = slice(max(cell[0]-radius, 0), cell[0]+radius+1)
+        cols = slice(max(cell[1]-radius, 0), cell[1]+radius+1)
+        
+        result = []
+        for i, variable in enumerate(self.variables()):
+            if self.series is not None:
+                series = np.array(self.series[i][rows, cols]).transpose(2, 0, 1)
+            else:
+                s = self.read_stride
+                with self.renderer.lock:
+                    series = variable[:, slice(rows.start*s, (rows.stop-1)*s + 1, s),
+                                      slice(cols.start*s, (cols.stop-1)*s + 1, s)]
+            result.append(series if radius > 0 else series[:, 0, 0])
+        return result[0] if len(result) == 1 else tuple(result)
+        
+    def render_range(self, start, stop, chunk=20):
+        """
+        Yields frames start to stop, rendering frames that are not cached.
+        Frames are read chunk at a time under the renderer lock and rendered
+        by the renderer, so the calling thread mostly waits. Used from the
+        video thread, see VizMap.enable_video.
+        """
+        def cache_frame(result):
+            self.set_cached(result[1], result[0])
+        
+        for c in range(start, stop, chunk):
+            n = min(chunk, stop - c)
+            todo = [i for i in range(c, c+n) if self.get_cached(i) == 0]
+            if todo:
+                with self.renderer.lock:
+                    frames = self.render_args(c, n)
+                results = [self.renderer.submit((self.key, args[0]), calc_frame,
+                                                args, cache_frame)
+                           for args in frames if args[0] in todo]
+                for r in results:
+                    r.wait()
+            
+            for i in range(c, c+n):
+                if self.get_cached(i) == 0:
+                    self.set_cached(i, self.render_frame(i))
+                yield self.cache[i]
+        
+    def prepare_video(self, start=0, stop=None, fps=20, path=None, url=None):
+        """
+        Encodes frames start to stop into a video, shown instead of the frames
+        while playing, see VizMap.enable_video. Not available for 'geojson'
+        wind layers. If encoding fails, the exception is kept in video_error.
+        
+        Arguments:
+        start (int): First frame of the video.
+        stop (int): Frame the video stops before. The last frame if None.
+        fps (int||float): Frames per second of the video.
+        path (string): Filename the video is written to. The video is kept
+            as data URL if None.
+        url (string): URL the browser loads the video at path from.
+        """
+        if getattr(self, 'method', None) == 'geojson':
+            raise ValueError("Video is not available for the 'geojson' method.")
+        stop = len(self) if stop is None else min(stop, len(self))
+        self.video_error = None
+        try:
+            result = encode_video(self.render_range(start, stop), fps, path)
+        except Exception as e:
+            self.video_error = e
+            raise
+        self.video = (result if path is None else url or path, start, stop, fps)
+        
     def __str__(self):
         return f"{self.layer_obj}, frame={self.frame}"
     
@@ -26,44 +182,119 @@ class Layer:
 
 class RasterLayer(Layer):
     """
-    Layer for regular, single-variable raster data.
+    Layer for single-variable raster data, on a regular grid or a 2d grid
+    given by 2d latitude and longitude variables, e.g. a curvilinear or
+    rotated-pole grid.
     """
     def __init__(self, file, data, time='time', lat='latitude',
-                 long='longitude', cmap='viridis', frame=0, name=None):
+                 long='longitude', cmap='viridis', files=(), resample=None,
+                 rolling=None, memmap=False, series_store=False, cache_dir=None,
+                 renderer=None, frame=0, name=None, interactive=True):
         """
         Arguments:
         file (string): Filename of dataset file to be visualized.
         data (string): Name of data variable to be visualized within dataset file.
+            May also be an expression over variables, e.g. 'sqrt(u**2 + v**2)',
+            which is evaluated per frame when read, see Expression.
         time (string): Name of time dimension within dataset file.
-        lat (string): Name of latitude dimension within dataset file.
-        long (string): Name of longitude dimension within dataset file.
+        lat (string): Name of latitude dimension within dataset file, or of
+            the 2d latitude variable for 2d grids.
+        long (string): Name of longitude dimension within dataset file, or of
+            the 2d longitude variable for 2d grids.
         cmap (string): Colormap name. Matplotlib colormaps are used.
+        files ([string]): Filenames of datasets on the same grid whose
+            variables may be used in data in addition to those of file.
+        resample (string): If given, frames are means over periods of 'hour',
+            'day', 'month' or 'year', see Resample.
+        rolling (int): If given, frames are rolling means over this many
+            frames, after resampling, see Rolling.
+        memmap (boolean): If True, frames are read from an uncompressed
+            float32 copy of the data variable that is memory mapped. The copy
+            is written next to the dataset file when it does not exist yet.
+        series_store (boolean): If True, time series are probed from an
+            uncompressed float32 copy of the data variable with time as the
+            fastest varying dimension, see probe. The copy is written next to
+            the dataset file when it does not exist yet.
+        cache_dir (string): Directory rendered frames are cached in across
+            sessions, see FrameCache. Frames are only cached in memory if None.
+        renderer (Renderer): Render engine shared with other layers. Layers
+            with the same file, variables and render parameters share their
+            frames. A renderer of the layer's own is created if None.
         frame (int): Frame first displayed.
         name (string): Layer name. Normally the index within the map.
+        interactive (boolean): If False, no map layer and widgets are created,
+            e.g. to render frames without a notebook.
         """
-        ds = nc.Dataset(file)
+        self.renderer = renderer if renderer is not None else Renderer()
+        ds = self.renderer.dataset(file)
+        datasets = [ds] + [self.renderer.dataset(f) for f in files]
         self.coords = [ds[lat][:], ds[long][:]]
-        self.data = ds[data]
+        self.data, origin, reference = open_variable(datasets, data)
         self.read_time(ds[time])
+        self.data, self.time = aggregate(self.data, self.time, resample, rolling)
+        # Stores are converted from the shared datasets.
+        with self.renderer.lock:
+            if series_store:
+                self.series = [get_store(file, self.data,
+                                         aggregate_name(data, resample, rolling),
+                                         series=True, files=files)]
+            self.memmap = memmap
+            self.read_stride = 1
+            if memmap:
+                self.data = get_store(file, self.data,
+                                      aggregate_name(data, resample, rolling),
+                                      files=files)
         self.cmap = cmap
-        self.cache = [0 for i in range(len(self.data))]
-        
-        tmp = gdal.Open(f"NETCDF:{file}:{data}")
-        t = tmp.GetGeoTransform()
-        t = [t[1], t[2], t[0], t[4], t[5], t[3]]
-        self.transform = Affine(*t)
-        del tmp
+        self.key = frame_cache_key(file, layer='raster', data=data, time=time,
+                                   lat=lat, long=long, cmap=cmap, files=files,
+                                   resample=resample, rolling=rolling)
+        self.cache = self.renderer.cache(self.key,
+                                         [0 for i in range(len(self.data))])
+        self.frame_cache = None
+        if cache_dir is not None:
+            self.frame_cache = FrameCache(cache_dir, self.key)
+        
+        # 2d grids are resampled with a nearest-neighbour index, see get_index.
+        self.curvilinear = np.ndim(self.coords[0]) == 2
+        if self.curvilinear:
+            self.transform = None
+            self.index = get_index(file, lat, long)
+        else:
+            tmp = gdal.Open(f"NETCDF:{origin.filepath()}:{reference}")
+            t = tmp.GetGeoTransform()
+            t = [t[1], t[2], t[0], t[4], t[5], t[3]]
+            self.transform = Affine(*t)
+            del tmp
         
         self.frame = frame
         self.bounds = calc_bounds(self.coords)
         self.bounds_img = calc_bounds(self.coords, type='edge')
-        self.create_layer(name)
+        self.grid = grid_key(*self.coords)
+        if interactive:
+            self.create_layer(name)
+        
+        
+    def variables(self):
+        return [self.data]
+        
+        
+    def render_args(self, start, n):
+        """
+        Returns the arguments of calc_frame rendering n frames from start.
+        """
+        data = self.read_frames(self.data, start, n)
+        if self.curvilinear:
+            return [(start+i, 'raster_index', data[i], self.index, self.cmap)
+                    for i in range(n)]
+        return [(start+i, 'raster', data[i], self.bounds_img, self.transform,
+                 self.cmap) for i in range(n)]
         
         
     def create_layer(self, name):
-        url = process_frame('raster', self.data[self.frame], self.bounds,
-                             self.transform, self.cmap)
-        self.cache[self.frame] = url
+        url = self.get_cached(self.frame)
+        if url == 0:
+            url = self.render_frame(self.frame)
+            self.set_cached(self.frame, url)
         self.buffer_frames(self.frame+1, 50)
         
         bounds = [(self.bounds_img[1], self.bounds_img[0]), 
@@ -105,51 +336,50 @@ class RasterLayer(Layer):
         
         
     def get_selection(self, selection):
-        if isinstance(selection, list) or isinstance(selection, tuple) or \
-                isinstance(selection, np.ndarray):
-            mask = find_selection(selection[0], self.coords[0], self.coords[1])
-            for i in range(1, len(selection)):
-                mask = mask & find_selection(selection[i], self.coords[0], self.coords[1])
-        else:
-            mask = find_selection(selection, self.coords[0], self.coords[1])
-        return np.ma.array(self.data[self.frame], mask=mask)
+        """
+        Returns the current frame within the selection(s) as a masked array
+        cropped to the bounding box of the selection(s).
+        """
+        mask = get_selection_mask(selection, *self.coords, grid=self.grid)
+        with self.renderer.lock:
+            return mask.select(self.data, self.frame)
 
 
     def update_frame(self, i=None):
         if i is None:
             i = self.frame + 1
         self.frame = i
+        if self.video_playing:
+            return
         
         if i % 10 == 0:
             self.buffer_frames(self.frame+1, 40)
             
-        if self.cache[i] != 0:
+        if self.get_cached(i) != 0:
             self.layer_obj.url = self.cache[i]
         else:
-            img = process_frame('raster', self.data[i], self.bounds_img,
-                                 self.transform, cmap=self.cmap)
+            img = self.render_frame(i)
             self.layer_obj.url = img
-            self.cache[i] = img
+            self.set_cached(i, img)
             self.buffer_frames(i+1, 50)#, finish=True)
             
     
     @debounce(0.3)    # Delay buffering when scrubbing through frames.
-    def buffer_frames(self, start, n, finish=False, processes=cpu_count()):
-        with threading.Lock():
-            data = self.data[start:start+n]
+    def buffer_frames(self, start, n, finish=False):
+        n = min(n, len(self.data) - start)
+        with self.renderer.lock:
+            frames = self.render_args(start, n)
             
         def cache_frame(result):
-            self.cache[result[1]] = result[0]
+            self.set_cached(result[1], result[0])
         
-        pool = Pool(processes=processes)
         results = []
         
-        for i in range(n):
-            if self.cache[start+i] != 0:
+        for args in frames:
+            if self.is_cached(args[0]):
                 continue
-            args = (start+i, 'raster', data[i], self.bounds_img,
-                    self.transform, self.cmap)
-            r = pool.apply_async(calc_frame, args, callback=cache_frame)
+            r = self.renderer.submit((self.key, args[0]), calc_frame, args,
+                                     cache_frame)
             results.append(r)
             
         if finish:
@@ -161,18 +391,27 @@ class WindLayer(Layer):
     """
     Layer for wind data consisting of eastward (u) and northward (v) velocity.
     """
+    view_cache_size = 100   # Frames of arrow tiles cached, see evict_views
+    
     def __init__(self, file, u='u', v='v', time='time', lat='latitude',
                  long='longitude', stride=1, method='geojson',
                  cmap='viridis', autoscale=True, color=False, scale_value=0.5,
-                 frame=0, name=None):
+                 compact=False, precision=3, tile_size=16, arrows=None,
+                 files=(), resample=None, rolling=None, memmap=False,
+                 series_store=False, cache_dir=None, renderer=None, frame=0,
+                 name=None, interactive=True):
         """
         Arguments:
         file (string): Filename of dataset file to be visualized.
         u (string): Name of data variable to be visualized within dataset file.
+            May also be an expression over variables, see Expression.
         v (string): Name of data variable to be visualized within dataset file.
+            May also be an expression over variables, see Expression.
         time (string): Name of time dimension within dataset file.
-        lat (string): Name of latitude dimension within dataset file.
-        long (string): Name of longitude dimension within dataset file.
+        lat (string): Name of latitude dimension within dataset file, or of
+            the 2d latitude variable for 2d grids.
+        long (string): Name of longitude dimension within dataset file, or of
+            the 2d longitude variable for 2d grids.
         stride (int): Using a stride of n means reading every nth value from
             the array. Higher stride results in less arrows and higher
             performance.
@@ -185,63 +424,174 @@ class WindLayer(Layer):
             Only available for 'quiver' method.
         scale_value (float||int): Scale value arrows arrows are scaled by,
             meaning depends on method and whether or not autoscaled.
+        compact (boolean): If True, arrows are sent as compact GeoJSON with
+            coordinates rounded to precision decimals, without the arrows of
+            missing values. Only available for 'geojson' method.
+        precision (int): Number of decimals of arrow coordinates if compact.
+        tile_size (int): Size in arrows of the sides of the tiles arrows are
+            generated and cached in if arrows is given.
+        arrows (int): If given, the stride is adapted to the zoom of the map,
+            keeping about this many arrows within the visible bounds. Arrows
+            are generated in tiles of tile_size, only for the visible bounds,
+            and cached per stride level. stride is the finest stride used.
+            Only available for 'geojson' method on regular grids.
+        files ([string]): Filenames of datasets on the same grid whose
+            variables may be used in u and v in addition to those of file.
+        resample (string): If given, frames are means over periods of 'hour',
+            'day', 'month' or 'year', see Resample.
+        rolling (int): If given, frames are rolling means over this many
+            frames, after resampling, see Rolling.
+        memmap (boolean): If True, frames are read from an uncompressed
+            float32 copy of u and v, after stride, that is memory mapped. The
+            copies are written next to the dataset file when they do not
+            exist yet.
+        series_store (boolean): If True, time series are probed from
+            uncompressed float32 copies of u and v, after stride, with time as
+            the fastest varying dimension, see probe. The copies are written
+            next to the dataset file when they do not exist yet.
+        cache_dir (string): Directory rendered frames are cached in across
+            sessions, see FrameCache. Frames are only cached in memory if None.
+        renderer (Renderer): Render engine shared with other layers. Layers
+            with the same file, variables and render parameters share their
+            frames. A renderer of the layer's own is created if None.
         frame (int): Frame first displayed.
         name (string): Layer name. Normally the index within the map.
+        interactive (boolean): If False, no map layer and widgets are created,
+            e.g. to render frames without a notebook.
         """
-        ds = nc.Dataset(file)
+        self.renderer = renderer if renderer is not None else Renderer()
+        ds = self.renderer.dataset(file)
+        datasets = [ds] + [self.renderer.dataset(f) for f in files]
         self.coords = [ds[lat], ds[long]]
-        self.u = ds[u]
-        self.v = ds[v]
-        self.stride = stride
+        self.u, origin, reference = open_variable(datasets, u)
+        self.v = open_variable(datasets, v)[0]
         self.read_time(ds[time])
-        self.cache = [0 for i in range(len(self.u))]
+        self.u, _ = aggregate(self.u, self.time, resample, rolling)
+        self.v, self.time = aggregate(self.v, self.time, resample, rolling)
+        self.stride = stride
+        # Stores are converted from the shared datasets.
+        with self.renderer.lock:
+            if series_store:
+                self.series = [get_store(file, self.u, aggregate_name(u, resample, rolling),
+                                         stride, series=True, files=files),
+                               get_store(file, self.v, aggregate_name(v, resample, rolling),
+                                         stride, series=True, files=files)]
+            self.memmap = memmap
+            self.read_stride = stride
+            if memmap:
+                self.u = get_store(file, self.u, aggregate_name(u, resample, rolling),
+                                   stride, files=files)
+                self.v = get_store(file, self.v, aggregate_name(v, resample, rolling),
+                                   stride, files=files)
+                self.read_stride = 1
         
         self.method = method
         self.cmap = cmap
         self.autoscale = autoscale
         self.color = color
         self.scale_value = scale_value
-        
-        tmp = gdal.Open(f"NETCDF:{file}:{u}")
-        t = tmp.GetGeoTransform()
-        t = [t[1]*stride, t[2], t[0], t[4], t[5]*stride, t[3]]
-        self.transform = Affine(*t)
-        del tmp
+        self.compact = compact and method == 'geojson'
+        self.precision = precision
+        self.tile_size = tile_size
+        self.arrows = arrows
+        if arrows and method != 'geojson':
+            raise ValueError("Adaptive arrow density is only available for "
+                             "the 'geojson' method.")
+        self.curvilinear = np.ndim(self.coords[0]) == 2
+        if arrows and self.curvilinear:
+            raise ValueError("Adaptive arrow density is not available for 2d "
+                             "grids.")
+        
+        self.key = frame_cache_key(file, layer='wind', method=method, u=u, v=v,
+                                   time=time, lat=lat, long=long, stride=stride,
+                                   cmap=cmap, autoscale=autoscale, color=color,
+                                   scale_value=scale_value, compact=self.compact,
+                                   precision=precision,
+                                   files=files, resample=resample, rolling=rolling)
+        self.cache = self.renderer.cache(self.key,
+                                         [0 for i in range(len(self.u))])
+        self.frame_cache = None
+        if cache_dir is not None:
+            self.frame_cache = FrameCache(cache_dir, self.key)
+        
+        if self.curvilinear:
+            self.transform = None
+            self.coords = [ds[lat][::stride, ::stride], ds[long][::stride, ::stride]]
+            if method == 'quiver':
+                self.index = get_index(file, lat, long, stride)
+        else:
+            tmp = gdal.Open(f"NETCDF:{origin.filepath()}:{reference}")
+            t = tmp.GetGeoTransform()
+            t = [t[1]*stride, t[2], t[0], t[4], t[5]*stride, t[3]]
+            self.transform = Affine(*t)
+            del tmp
         
         self.frame = frame
         self.bounds = calc_bounds(self.coords)
         self.bounds_img = calc_bounds(self.coords, type='edge')
-        self.coords = [ds[lat][::self.stride], ds[long][::self.stride]]
-        self.create_layer(name)
+        if not self.curvilinear:
+            self.coords = [ds[lat][::self.stride], ds[long][::self.stride]]
+        self.grid = grid_key(*self.coords)
+        self.view_bounds = self.bounds
+        self.view_cache = self.renderer.cache((self.key, 'view'), {})
+        self.level = 0
+        if interactive:
+            self.create_layer(name)
         
         
-    def get_frame(self, frame):
+    def variables(self):
+        return [self.u, self.v]
+        
+        
+    def render_args(self, start, n):
+        """
+        Returns the arguments of calc_frame rendering n frames from start.
+        """
+        u = self.read_frames(self.u, start, n)
+        v = self.read_frames(self.v, start, n)
+        
         if self.method == 'geojson':
-            return process_frame('geojson', self.u[frame][::self.stride, ::self.stride],
-                            self.v[frame][::self.stride, ::self.stride],
-                            self.coords[1], self.coords[0], self.autoscale,
-                            self.scale_value)
+            compact = (True, self.precision) if self.compact else ()
+            return [(start+i, 'geojson', u[i], v[i], self.coords[1],
+                     self.coords[0], self.autoscale, self.scale_value) + compact
+                    for i in range(n)]
+        elif self.method == 'quiver' and self.curvilinear:
+            return [(start+i, 'quiver_index', u[i], v[i], self.index,
+                     self.autoscale, self.color, self.scale_value, self.cmap)
+                    for i in range(n)]
         elif self.method == 'quiver':
-            return process_frame('quiver', self.u[frame][::self.stride, ::self.stride],
-                             self.v[frame][::self.stride, ::self.stride],
-                             self.bounds, self.transform, self.autoscale,
-                             self.color, self.scale_value, cmap=self.cmap)
+            return [(start+i, 'quiver', u[i], v[i], self.bounds_img,
+                     self.transform, self.autoscale, self.color,
+                     self.scale_value, self.cmap) for i in range(n)]
         
         
-    def create_layer(self, name):
-        frame = self.get_frame(self.frame)
-        self.cache[self.frame] = frame
+    def get_frame(self, frame):
+        return self.render_frame(frame)
         
+        
+    def create_layer(self, name):
         bounds = [(self.bounds_img[1], self.bounds_img[0]),
                   (self.bounds_img[3], self.bounds_img[2])]
+        style = {"color": "#000000", "weight": 1, "opacity": 0.65}
+        
+        if self.arrows:
+            # Frames are shown once the visible bounds are known.
+            frame = {'type': 'MultiLineString', 'coordinates': []}
+        else:
+            frame = self.get_cached(self.frame)
+            if frame == 0:
+                frame = self.get_frame(self.frame)
+                self.set_cached(self.frame, frame)
         
         if self.method == 'geojson':
-            self.layer_obj = GeoJSON(data=frame, name=name,style={"color":"#000000",
-                                     "weight": 1, "opacity": 0.65})
+            self.layer_obj = GeoJSON(data=frame, name=name, style=style)
         elif self.method == 'quiver':
             self.layer_obj = ImageOverlay(url=frame, bounds=bounds, opacity=0.5, name=name)
         
-        self.buffer_frames(self.frame+1, 50)
+        if self.arrows:
+            self.update_view()
+        else:
+            self.buffer_frames(self.frame+1, 50)
         
         
         frame_slider = IntSlider(
@@ -269,67 +619,209 @@ class WindLayer(Layer):
         
         
     def get_selection(self, selection):
-        if isinstance(selection, list) or isinstance(selection, tuple) or \
-                isinstance(selection, np.ndarray):
-            mask = find_selection(selection[0], self.coords[0], self.coords[1])
-            for i in range(1, len(selection)):
-                mask = mask & find_selection(selection[i], self.coords[0], self.coords[1])
-        else:
-            mask = find_selection(selection, self.coords[0], self.coords[1])
-        return (np.ma.array(self.u[self.frame], mask=mask),
-                np.ma.array(self.u[self.frame], mask=mask))
+        """
+        Returns u and v of the current frame within the selection(s) as
+        masked arrays cropped to the bounding box of the selection(s).
+        """
+        mask = get_selection_mask(selection, *self.coords, grid=self.grid)
+        with self.renderer.lock:
+            return (mask.select(self.u, self.frame, self.read_stride),
+                    mask.select(self.v, self.frame, self.read_stride))
+    
+
+    def show_frame(self, frame):
+        if self.method == 'geojson':
+            self.layer_obj.data = frame
+        elif self.method == 'quiver':
+            self.layer_obj.url = frame
+    
+
+    def view_grid(self, level):
+        """
+        Returns the latitude and longitude of the grid of stride level.
+        """
+        step = 2**level
+        return self.coords[0][::step], self.coords[1][::step]
+    
+    
+    def view_level(self, bounds):
+        """
+        Returns the finest stride level with at most self.arrows arrows
+        within bounds. Each level doubles the stride of the previous one.
+        """
+        rows, cols = visible_window(bounds, *self.coords)
+        count = (rows.stop-rows.start) * (cols.stop-cols.start)
+        level = 0
+        while count / 4**level > self.arrows and \
+                2**level < max(len(self.coords[0]), len(self.coords[1])):
+            level += 1
+        return level
+    
+    
+    def view_tiles(self, level):
+        """
+        Returns the ranges of tile rows and columns of stride level that are
+        within the visible bounds.
+        """
+        rows, cols = visible_window(self.view_bounds, *self.view_grid(level))
+        T = self.tile_size
+        return (range(rows.start // T, -(-rows.stop // T)),
+                range(cols.start // T, -(-cols.stop // T)))
+    
+    
+    def view_args(self, start, n, level, ty, tx):
+        """
+        Returns the arguments of calc_frame rendering tiles ty, tx of stride
+        level for n frames from start.
+        """
+        if len(ty) == 0 or len(tx) == 0:
+            return []
+        
+        T = self.tile_size
+        lat, long = self.view_grid(level)
+        rows = slice(ty.start*T, min(ty.stop*T, len(lat)))
+        cols = slice(tx.start*T, min(tx.stop*T, len(long)))
+        
+        r = self.read_stride * 2**level
+        index = (slice(start, start+n),
+                 slice(rows.start*r, (rows.stop-1)*r + 1, r),
+                 slice(cols.start*r, (cols.stop-1)*r + 1, r))
+        with self.renderer.lock:
+            u = self.u[index]
+            v = self.v[index]
+        
+        precision = self.precision if self.compact else None
+        return [(start+i, 'geojson', u[i], v[i], long[cols], lat[rows],
+                 self.autoscale, self.scale_value, self.compact, precision, T)
+                for i in range(n)]
+    
+    
+    def cache_view(self, level, ty, tx, result):
+        tiles, frame = result
+        cache = self.view_cache.setdefault((level, frame), {})
+        for k, tile in enumerate(tiles):
+            cache[(ty.start + k // len(tx), tx.start + k % len(tx))] = tile
+        self.evict_views()
+    
+    
+    def evict_views(self):
+        """
+        Removes the cached tiles of other stride levels than the current one,
+        and of the least recently shown frames beyond view_cache_size.
+        """
+        for key in [k for k in list(self.view_cache) if k[0] != self.level]:
+            self.view_cache.pop(key, None)
+        while len(self.view_cache) > self.view_cache_size:
+            self.view_cache.pop(next(iter(self.view_cache)), None)
+    
+    
+    def view_cached(self, frame, level, ty, tx):
+        cache = self.view_cache.get((level, frame), {})
+        return all((y, x) in cache for y in ty for x in tx)
+    
+    
+    def show_view(self, i):
+        """
+        Shows the tiles of frame i within the visible bounds at the current
+        stride level, rendering tiles that are not cached yet.
+        """
+        level = self.level
+        ty, tx = self.view_tiles(level)
+        # Reinserted below, so the cache keeps the most recently shown frames.
+        cache = self.view_cache.pop((level, i), {})
+        if not all((y, x) in cache for y in ty for x in tx):
+            for args in self.view_args(i, 1, level, ty, tx):
+                tiles = calc_frame(*args)[0]
+                for k, tile in enumerate(tiles):
+                    cache[(ty.start + k // len(tx), tx.start + k % len(tx))] = tile
+        self.view_cache[(level, i)] = cache
+        self.evict_views()
+        
+        coords = []
+        for y in ty:
+            for x in tx:
+                coords += cache[(y, x)]['coordinates']
+        
+        # Whole tiles extend beyond the visible bounds, only the arrows
+        # within them are sent.
+        arrows = np.array(coords, dtype=float).reshape(-1, 5, 2)
+        west, south, east, north = self.view_bounds
+        center = (arrows[:, 0] + arrows[:, 1]) / 2
+        visible = (center[:, 0] >= west) & (center[:, 0] <= east) & \
+                  (center[:, 1] >= south) & (center[:, 1] <= north)
+        self.layer_obj.data = {'type': 'MultiLineString',
+                               'coordinates': arrows[visible].tolist()}
+    
+    
+    def update_view(self, change=None):
+        """
+        Picks the stride level for the visible bounds and shows the current
+        frame. Observes the bounds of the map, see VizMap.add_wind.
+        """
+        if change is not None and change['new']:
+            (south, west), (north, east) = change['new']
+            self.view_bounds = (west, south, east, north)
+        self.level = self.view_level(self.view_bounds)
+        self.show_view(self.frame)
+        self.buffer_frames(self.frame+1, 20)
     
 
     def update_frame(self, i=None):
         if i is None:
             i = self.frame + 1
         self.frame = i
+        if self.video_playing:
+            return
         
         if i % 10 == 0:
             self.buffer_frames(self.frame+1, 40)
             
-        if self.cache[i] != 0:
-            if self.method == 'geojson':
-                self.layer_obj.data = self.cache[i]
-            elif self.method == 'quiver':
-                self.layer_obj.url = self.cache[i]
+        if self.arrows:
+            self.show_view(i)
+        elif self.get_cached(i) != 0:
+            self.show_frame(self.cache[i])
         else:
             frame = self.get_frame(i)
-            
-            if self.method == 'geojson':
-                self.layer_obj.data = frame
-            elif self.method == 'quiver':
-                self.layer_obj.url = frame
-                
-            self.cache[i] = frame
+            self.show_frame(frame)
+            self.set_cached(i, frame)
             self.buffer_frames(i+1, 50)
         
         
     @debounce(0.3)    # Delay buffering when scrubbing through frames.
-    def buffer_frames(self, start, n, finish=False, processes=cpu_count()):
-        with threading.Lock():
-            u = self.u[start:start+n, ::self.stride, ::self.stride]
-            v = self.v[start:start+n, ::self.stride, ::self.stride]
-        
-        def cache_frame(result):
-            self.cache[result[1]] = result[0]
+    def buffer_frames(self, start, n, finish=False):
+        n = min(n, len(self.u) - start)
+        
+        if self.arrows:
+            level = self.level
+            ty, tx = self.view_tiles(level)
+            todo = [i for i in range(start, start+n)
+                    if not self.view_cached(i, level, ty, tx)]
+            if not todo:
+                return
+            frames = [args for args in
+                      self.view_args(todo[0], todo[-1]-todo[0]+1, level, ty, tx)
+                      if args[0] in todo]
+            
+            def cache_frame(result):
+                self.cache_view(level, ty, tx, result)
+        else:
+            with self.renderer.lock:
+                frames = self.render_args(start, n)
+            
+            def cache_frame(result):
+                self.set_cached(result[1], result[0])
         
-        pool = Pool(processes=processes)
         results = []
         
-        for i in range(n):
-            if self.cache[start+i] != 0:
+        for args in frames:
+            if self.arrows:
+                job = (self.key, args[0], level, ty, tx)
+            elif self.is_cached(args[0]):
                 continue
+            else:
+                job = (self.key, args[0])
                 
-            if method == 'geojson':
-                args = (start+i, 'geojson', u[i], v[i], self.coords[1],
-                        self.coords[0], self.autoscale, self.scale_value)
-            elif method == 'quiver':
-                args = (start+i, 'quiver', u[i], v[i], self.bounds_img,
-                        self.transform, self.autoscale, self.color,
-                        self.scale_value,  self.cmap)
-                
-            r = pool.apply_async(calc_frame, args, callback=cache_frame)
+            r = self.renderer.submit(job, calc_frame, args, cache_frame)
             results.append(r)
             
         if finish:
@@ -338,16 +830,44 @@ class WindLayer(Layer):
                 
                 
 def calc_frame(frame, method, *args, **kwargs):
+    args = [load_frame(a) if isinstance(a, FrameRef) else a for a in args]
     if method == 'raster':
         img = process_frame_raster(*args, **kwargs)
     elif method == 'geojson':
         img = process_frame_geojson(*args, **kwargs)
     elif method == 'quiver':
         img = process_frame_quiver(*args, **kwargs)
+    elif method == 'raster_index':
+        img = process_frame_raster_index(*args, **kwargs)
+    elif method == 'quiver_index':
+        img = process_frame_quiver_index(*args, **kwargs)
     return img, frame
 
 
+def visible_window(bounds, lat, long):
+    """
+    Returns the row and column slices of the grid within bounds.
+    
+    Arguments:
+    bounds ([float: left, float: bottom, float: right, float: top]): Bounds
+        in longitude and latitude.
+    lat ([int]): Array of latitude coordinates of the grid.
+    long ([int]): Array of longitude coordinates of the grid.
+    """
+    left, bottom, right, top = bounds
+    rows = np.nonzero((lat >= bottom) & (lat <= top))[0]
+    cols = np.nonzero((long >= left) & (long <= right))[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return slice(0, 0), slice(0, 0)
+    return slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1)
+
+
 def calc_bounds(coords, step=None, type='true'):
+    if np.ndim(coords[0]) == 2:
+        # Images of 2d grids span the cell centers, see build_index.
+        return (float(np.min(coords[1])), float(np.min(coords[0])),
+                float(np.max(coords[1])), float(np.max(coords[0])))
+
     left = min(coords[1])
     bottom = min(coords[0])
     right = max(coords[1])
@@ -1,4 +1,7 @@
 import math
+import shutil
+import subprocess
+import tempfile
 import PIL
 import rasterio
 import numpy as np
@@ -7,10 +10,12 @@ import matplotlib.pyplot as plt
 from multiprocessing import Pool, Process
 from affine import Affine
 from rasterio.warp import reproject, Resampling, calculate_default_transform
-from base64 import b64encode
+from base64 import b64encode, b64decode
 from io import BytesIO
 from geojson import MultiLineString
 
+from .regrid import load_index
+
 
 def process_frame(method, *args, **kwargs):
     if method == 'raster':
@@ -19,6 +24,10 @@ def process_frame(method, *args, **kwargs):
         return process_frame_geojson(*args, **kwargs)
     elif method == 'quiver':
         return process_frame_quiver(*args, **kwargs)
+    elif method == 'raster_index':
+        return process_frame_raster_index(*args, **kwargs)
+    elif method == 'quiver_index':
+        return process_frame_quiver_index(*args, **kwargs)
     
 
 def process_frame_raster(data, bounds, src_transform, cmap='viridis'):
@@ -53,6 +62,36 @@ def process_frame_raster(data, bounds, src_transform, cmap='viridis'):
             dst_crs=dst_crs,
             resampling=Resampling.nearest)
     
+    return encode_image(dst, cmap)
+
+
+def process_frame_raster_index(data, index, cmap='viridis'):
+    """
+    Resample data on a 2d grid to Mercator projection with a nearest-neighbour
+    index and return a base64 encoded image.
+    
+    Arguments:
+    data (2d matrix y:x): Raster data to be processed.
+    index (2d matrix y:x||string): Resampling index or its path, see
+        regrid.build_index.
+    """
+    return encode_image(gather(data, index), cmap)
+
+
+def gather(data, index):
+    """
+    Resamples data with a nearest-neighbour index, see regrid.build_index.
+    """
+    if isinstance(index, str):
+        index = load_index(index)
+    data = np.ma.filled(np.ma.asarray(data, dtype=float), np.nan).ravel()
+    return np.where(index >= 0, data[index], np.nan)
+
+
+def encode_image(dst, cmap='viridis'):
+    """
+    Color data with a colormap and return it as base64 encoded PNG image.
+    """
     data_norm = dst - np.nanmin(dst)
     data_norm = data_norm / np.nanmax(data_norm)
     data_norm = np.where(np.isfinite(dst), data_norm, 0)
@@ -116,6 +155,31 @@ def process_frame_quiver(u, v, bounds, src_transform, autoscale=True, color=True
             dst_crs=dst_crs,
             resampling=Resampling.nearest)
 
+    return plot_quiver(dst_u, dst_v, autoscale, color, scale_value)
+
+
+def process_frame_quiver_index(u, v, index, autoscale=True, color=True,
+                               scale_value=None, cmap='viridis'):
+    """
+    Resample vector field data on a 2d grid to Mercator projection with a
+    nearest-neighbour index, display as vector plot and return a base64
+    encoded image. See process_frame_quiver.
+    
+    Arguments:
+    u ([y:x]): Eastward direction component of vector.
+    v ([y:x]): Northward direction component of vector.
+    index (2d matrix y:x||string): Resampling index or its path, see
+        regrid.build_index.
+    """
+    return plot_quiver(gather(u, index), gather(v, index), autoscale, color,
+                       scale_value)
+
+
+def plot_quiver(dst_u, dst_v, autoscale=True, color=True, scale_value=None):
+    """
+    Display vector field data in Mercator projection as vector plot and
+    return a base64 encoded image.
+    """
     fig, ax = plt.subplots()
     
     if not autoscale:
@@ -147,33 +211,60 @@ def process_frame_quiver(u, v, bounds, src_transform, autoscale=True, color=True
     return imgurl
 
 
-def process_frame_geojson(u, v, long, lat, autoscale=True, scale=0.5):
+def process_frame_geojson(u, v, long, lat, autoscale=True, scale=0.5,
+                          compact=False, precision=None, tile=None):
     """
     Generates arrows in a GeoJSON format from vector field data.
     
     Arguments:
     u ([time:y:x]): Eastward direction component of vector.
     v ([time:y:x]): Northward direction component of vector.
-    long ([int]): Array of longitude values.
-    long ([int]): Array of latitude values.
+    long ([int]): Array of longitude values, or 2d matrix for 2d grids.
+    long ([int]): Array of latitude values, or 2d matrix for 2d grids.
     autoscale (boolean) (default: True): If True, scale arrows according to magnitude. If 
         False, All arrows have the same size.
     scale (float) (default: 0.5): Arrow scale in coordinates relative to arrow
         magnitude if not autoscaled.
+    compact (boolean) (default: False): If True, arrows of missing values are
+        dropped and plain dicts are returned instead of geojson objects. Arrows
+        have the same shape as when not compact.
+    precision (int) (default: None): Number of decimals coordinates are
+        rounded to. Not rounded if None.
+    tile (int) (default: None): If given, a list of MultiLineStrings is
+        returned, one per tile of tile by tile arrows in row-major order.
     """
-    arrows = []
-    length = 0
+    u = np.ma.filled(np.ma.asarray(u, dtype=float), np.nan)
+    v = np.ma.filled(np.ma.asarray(v, dtype=float), np.nan)
+    if np.ndim(lat) == 1:
+        long, lat = np.meshgrid(long, lat)
+    
+    # Arrows as [y, x, point, coordinate]
+    arrows = np.array(calc_arrow(u, v, long, lat, autoscale, scale))
+    arrows = arrows.transpose(2, 3, 0, 1)
     
-    for i in range(len(lat)):
-        for j in range(len(long)):
-            arrows.append(calc_arrow(u[i][j], v[i][j], long[j], lat[i], autoscale, scale))
+    if precision is not None:
+        arrows = np.round(arrows, precision)
     
-    return MultiLineString(arrows)
+    if tile is None:
+        return arrows_to_geojson(arrows, compact)
+    
+    rows, cols = arrows.shape[:2]
+    return [arrows_to_geojson(arrows[y:y+tile, x:x+tile], compact)
+            for y in range(0, rows, tile) for x in range(0, cols, tile)]
+
+
+def arrows_to_geojson(arrows, compact):
+    arrows = arrows.reshape(-1, arrows.shape[-2], 2)
+    if compact:
+        arrows = arrows[np.isfinite(arrows).all(axis=(1, 2))]
+        return {'type': 'MultiLineString', 'coordinates': arrows.tolist()}
+    return MultiLineString(arrows.tolist())
 
 
 def calc_arrow(u, v, long, lat, autoscale, scale):
     """
-    Calculates coordinates specifying an arrow.
+    Calculates coordinates specifying an arrow. All arguments but autoscale
+    and scale may also be arrays, calculating an arrow per element.
     
     Arguments:
     u (float): Eastward direction component of vector.
@@ -212,3 +303,59 @@ def calc_arrow(u, v, long, lat, autoscale, scale):
     head_r = [end[0] - dx_head_r, end[1] - dy_head_r]
     
     return [begin, end, head_l, end, head_r]
+
+
+def encode_video(frames, fps=20, path=None):
+    """
+    Encodes frames into a WebM video, keeping transparency, and returns it as
+    a base64 encoded data URL, or writes it to path and returns path.
+    Requires ffmpeg.
+    
+    Arguments:
+    frames ([string]): Frames as base64 encoded PNG data URLs, e.g. from
+        process_frame_raster or process_frame_quiver. Frames of a different
+        size than the first are resized.
+    fps (int||float) (default: 20): Frames per second of the video.
+    path (string) (default: None): Filename the video is written to.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError("Encoding video requires ffmpeg.")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        out = f"{tmp}/video.webm"
+        proc = None
+        
+        for url in frames:
+            im = PIL.Image.open(BytesIO(b64decode(url.split(',', 1)[1])))
+            im = im.convert('RGBA')
+            
+            if proc is None:
+                size = im.size
+                proc = subprocess.Popen(
+                    [ffmpeg, '-loglevel', 'error', '-y',
+                     '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                     '-s', f"{size[0]}x{size[1]}", '-r', str(fps), '-i', '-',
+                     '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                     '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuva420p',
+                     '-b:v', '0', '-crf', '30', out],
+                    stdin=subprocess.PIPE)
+            elif im.size != size:
+                im = im.resize(size)
+                
+            proc.stdin.write(im.tobytes())
+        
+        if proc is None:
+            raise ValueError("No frames to encode.")
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {proc.returncode}.")
+        
+        if path is not None:
+            shutil.move(out, path)
+            return path
+        
+        with open(out, 'rb') as f:
+            data = b64encode(f.read()).decode('ascii')
+    
+    return 'data:video/webm;base64,' + data
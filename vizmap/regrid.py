@@ -0,0 +1,128 @@
+import os
+import numpy as np
+import netCDF4 as nc
+from scipy.spatial import cKDTree
+
+
+RADIUS = 6378137    # Earth radius of the Web Mercator projection in m
+
+_indices = {}
+
+
+def mercator(lat, long):
+    """
+    Projects latitude and longitude to Web Mercator (EPSG:3857).
+    """
+    x = RADIUS * np.radians(long)
+    y = RADIUS * np.log(np.tan(np.pi/4 + np.radians(lat)/2))
+    return x, y
+
+
+def inverse_mercator(x, y):
+    """
+    Projects Web Mercator (EPSG:3857) coordinates to latitude and longitude.
+    """
+    lat = np.degrees(2*np.arctan(np.exp(y / RADIUS)) - np.pi/2)
+    long = np.degrees(x / RADIUS)
+    return lat, long
+
+
+def unit_vectors(lat, long):
+    """
+    Returns the points lat, long as 3d unit vectors, so distances between
+    them do not depend on where they are on the globe.
+    """
+    lat = np.radians(np.ravel(lat))
+    long = np.radians(np.ravel(long))
+    return np.column_stack((np.cos(lat) * np.cos(long),
+                            np.cos(lat) * np.sin(long),
+                            np.sin(lat)))
+
+
+def build_tree(lat, long):
+    """
+    Returns a KD-tree of the cells of a 2d grid, and the distance within
+    which a point is considered to be on the grid: twice the typical
+    distance between neighbouring cells.
+
+    Arguments:
+    lat ([[int]]): Latitude of each cell.
+    long ([[int]]): Longitude of each cell.
+    """
+    tree = cKDTree(unit_vectors(lat, long))
+    sample = tree.data[::max(len(tree.data) // 10000, 1)]
+    distances, _ = tree.query(sample, k=2)
+    return tree, 2 * np.median(distances[:, 1])
+
+
+def build_index(lat, long):
+    """
+    Builds the nearest-neighbour index resampling a 2d grid, e.g. a
+    curvilinear or rotated-pole grid, to a Web Mercator image of about as
+    many pixels as the grid has cells. Returns, for every pixel from the top
+    left, the flat index of its nearest cell, or -1 for pixels not on the
+    grid.
+
+    Arguments:
+    lat ([[int]]): Latitude of each cell.
+    long ([[int]]): Longitude of each cell.
+    """
+    lat = np.ma.filled(np.ma.asarray(lat, dtype=float), np.nan)
+    long = np.ma.filled(np.ma.asarray(long, dtype=float), np.nan)
+    left, bottom, right, top = (np.nanmin(long), np.nanmin(lat),
+                                np.nanmax(long), np.nanmax(lat))
+    x0, y0 = mercator(bottom, left)
+    x1, y1 = mercator(top, right)
+
+    height = max(int(round(np.sqrt(lat.size * (y1-y0) / (x1-x0)))), 1)
+    width = max(int(round(lat.size / height)), 1)
+
+    x = x0 + (np.arange(width) + 0.5) * (x1-x0) / width
+    y = y1 - (np.arange(height) + 0.5) * (y1-y0) / height
+    x, y = np.meshgrid(x, y)
+
+    tree, reach = build_tree(lat, long)
+    distances, index = tree.query(unit_vectors(*inverse_mercator(x, y)),
+                                  distance_upper_bound=reach)
+    index[~np.isfinite(distances)] = -1
+
+    return index.astype(np.int32).reshape(height, width)
+
+
+def index_path(file, lat, long, stride=1):
+    """
+    Returns the path of the resampling index of a grid, next to the dataset.
+    """
+    root = os.path.splitext(file)[0]
+    suffix = f".s{stride}" if stride != 1 else ''
+    return f"{root}.{lat}.{long}{suffix}.index.npy"
+
+
+def get_index(file, lat, long, stride=1):
+    """
+    Returns the path of the resampling index of the 2d grid of a dataset,
+    building it first if it does not exist or is older than the dataset.
+    Workers load the index by path once, see load_index.
+
+    Arguments:
+    file (string): Filename of dataset file.
+    lat (string): Name of 2d latitude variable within dataset file.
+    long (string): Name of 2d longitude variable within dataset file.
+    stride (int): Stride the grid is read with.
+    """
+    path = index_path(file, lat, long, stride)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(file):
+        ds = nc.Dataset(file)
+        index = build_index(ds[lat][::stride, ::stride], ds[long][::stride, ::stride])
+        np.save(path, index)
+        _indices.pop(path, None)
+    return path
+
+
+def load_index(path):
+    """
+    Loads a resampling index. Indices are loaded once per process.
+    """
+    if path not in _indices:
+        _indices[path] = np.load(path)
+    return _indices[path]
@@ -0,0 +1,99 @@
+import threading
+import netCDF4 as nc
+from multiprocessing import Pool, cpu_count
+
+
+class Renderer:
+    """
+    Render engine shared by layers, e.g. the layers of linked maps, see
+    LinkedMaps. Layers render their frames in one process pool instead of a
+    pool per layer, and layers rendering the same frames, i.e. with the same
+    cache key, share their cache. A frame that is being rendered for one
+    layer is not rendered again for another. Datasets are opened once and
+    shared between layers.
+    """
+    def __init__(self, processes=cpu_count()):
+        """
+        Arguments:
+        processes (int): Number of render processes.
+        """
+        self.processes = processes
+        self.pool = None
+        self.caches = {}
+        self.datasets = {}
+        self.pending = {}
+        # Held while reading from the shared datasets, netCDF is not thread safe.
+        self.lock = threading.RLock()
+
+    def dataset(self, file):
+        """
+        Returns the dataset file, opening it if it is not open yet.
+        """
+        with self.lock:
+            if file not in self.datasets:
+                self.datasets[file] = nc.Dataset(file)
+            return self.datasets[file]
+
+    def cache(self, key, default):
+        """
+        Returns the cache of frames rendered with key, or default if there is
+        none yet, which then becomes the cache shared by key.
+        """
+        with self.lock:
+            return self.caches.setdefault(key, default)
+
+    def submit(self, job, func, args, callback):
+        """
+        Renders func(*args) in the pool, calling callback with the result.
+        Jobs that are already pending are not submitted again, and their
+        callback is not called for this submission.
+
+        Arguments:
+        job (tuple): Key identifying the job, e.g. (cache key, frame).
+        func (function): Function called in a render process.
+        args (tuple): Arguments of func.
+        callback (function): Called with the result in the main process.
+        """
+        with self.lock:
+            if job in self.pending:
+                return self.pending[job]
+            if self.pool is None:
+                self.pool = Pool(processes=self.processes)
+
+            def done(result):
+                self.pending.pop(job, None)
+                callback(result)
+
+            def failed(error):
+                self.pending.pop(job, None)
+
+            r = self.pool.apply_async(func, args, callback=done,
+                                      error_callback=failed)
+            self.pending[job] = r
+            return r
+
+    def wait(self, job):
+        """
+        Waits for job if it is pending and returns its result, else returns
+        None.
+        """
+        r = self.pending.get(job)
+        if r is None:
+            return None
+        try:
+            return r.get()
+        except Exception:
+            return None
+
+    def close(self):
+        """
+        Stops the render processes and closes the shared datasets.
+        """
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+            self.pending.clear()
+            for ds in self.datasets.values():
+                ds.close()
+            self.datasets.clear()
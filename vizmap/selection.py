@@ -1,6 +1,210 @@
+import json
+import hashlib
 import matplotlib.path as mplPath
 import numpy as np
-from math import sin, cos, radians, sqrt, atan2, asin
+
+
+class SelectionMask:
+    """
+    Compact selection mask. Only the bounding box of the selection within the
+    grid is stored, as a pair of slices, together with the mask cropped to
+    that box. As with the full masks, True masks points not in the selection.
+    """
+    def __init__(self, rows, cols, mask):
+        """
+        Arguments:
+        rows (slice): Rows of the grid covered by the selection.
+        cols (slice): Columns of the grid covered by the selection.
+        mask (2d boolean matrix y:x): Mask cropped to rows and cols.
+        """
+        self.rows = rows
+        self.cols = cols
+        self.mask = mask
+
+    def union(self, other):
+        """
+        Returns the mask selecting the points of both self and other.
+        """
+        if self.mask.size == 0:
+            return other
+        if other.mask.size == 0:
+            return self
+
+        rows = slice(min(self.rows.start, other.rows.start),
+                     max(self.rows.stop, other.rows.stop))
+        cols = slice(min(self.cols.start, other.cols.start),
+                     max(self.cols.stop, other.cols.stop))
+        mask = np.full((rows.stop-rows.start, cols.stop-cols.start), True)
+
+        for m in (self, other):
+            mask[m.rows.start-rows.start:m.rows.stop-rows.start,
+                 m.cols.start-cols.start:m.cols.stop-cols.start] &= m.mask
+
+        return SelectionMask(rows, cols, mask)
+
+    def full(self, shape):
+        """
+        Expands the mask to a full mask of the grid with the given shape.
+        """
+        mask = np.full(shape, True)
+        mask[self.rows, self.cols] = self.mask
+        return mask
+
+    def slices(self, stride=1):
+        """
+        Returns the row and column slices of the selection into data that is
+        read with the given stride.
+        """
+        return tuple(slice(s.start*stride, max(s.stop-1, s.start)*stride + 1, stride)
+                     if s.stop > s.start else slice(0, 0)
+                     for s in (self.rows, self.cols))
+
+    def select(self, data, frame, stride=1):
+        """
+        Reads the selection from a frame of data. Only the bounding box of
+        the selection is read, the result is a masked array of that box.
+
+        Arguments:
+        data ([time:y:x]): Data the selection is read from.
+        frame (int): Index of the frame the selection is read from.
+        stride (int): Stride the grid of the selection has within data.
+        """
+        rows, cols = self.slices(stride)
+        return np.ma.array(data[frame, rows, cols], mask=self.mask)
+
+
+_mask_cache = {}
+
+
+def selection_key(selection):
+    """
+    Returns a hashable key identifying the geometry of a selection.
+    """
+    key = json.dumps(selection['geometry'], sort_keys=True)
+    if selection['geometry']['type'] == 'Point':
+        key += f":{selection['properties']['style']['radius']}"
+    return key
+
+
+def grid_key(lat, long):
+    """
+    Returns a hashable key identifying the grid given by lat and long, so
+    layers on the same grid share their selection masks.
+    """
+    digest = hashlib.sha1()
+    for coords in (lat, long):
+        coords = np.ma.filled(np.ma.asarray(coords, dtype=np.float64), np.nan)
+        digest.update(str(coords.shape).encode())
+        digest.update(np.ascontiguousarray(coords).tobytes())
+    return digest.hexdigest()
+
+
+def get_selection_mask(selection, lat, long, grid=None):
+    """
+    Returns the compact mask of one or multiple selections. Masks are cached
+    by selection geometry and grid, so they are computed once for all frames
+    and layers on the same grid. Multiple selections are combined, selecting
+    the points in any of them.
+
+    Arguments:
+    selection (dict||[dict]): GeoJSON of selection(s) drawn on the map.
+    lat ([int]): Array of latitude coordinates the selection should be found in,
+        or 2d matrix of the latitude of each cell for 2d grids.
+    long ([int]): Array of longitude coordinates the selection should be found in,
+        or 2d matrix of the longitude of each cell for 2d grids.
+    grid (tuple): Key of the grid as returned by grid_key. Computed from lat
+        and long if not given.
+    """
+    if grid is None:
+        grid = grid_key(lat, long)
+
+    if isinstance(selection, list) or isinstance(selection, tuple) or \
+            isinstance(selection, np.ndarray):
+        mask = get_selection_mask(selection[0], lat, long, grid)
+        for i in range(1, len(selection)):
+            mask = mask.union(get_selection_mask(selection[i], lat, long, grid))
+        return mask
+
+    key = (selection_key(selection), grid)
+    if key not in _mask_cache:
+        _mask_cache[key] = find_selection_compact(selection, lat, long)
+    return _mask_cache[key]
+
+
+def invalidate_selection(selection):
+    """
+    Removes the cached masks of a selection for all grids.
+    """
+    key = selection_key(selection)
+    for k in [k for k in _mask_cache if k[0] == key]:
+        del _mask_cache[k]
+
+
+def prune_selections(selections, previous):
+    """
+    Removes the cached masks of the selections in previous that are no longer
+    in selections. Masks of selections of other maps are kept.
+    """
+    keys = set(selection_key(s) for s in selections)
+    removed = set(selection_key(s) for s in previous) - keys
+    for k in [k for k in _mask_cache if k[0] in removed]:
+        del _mask_cache[k]
+
+
+def grid_shape(lat, long):
+    if np.ndim(lat) == 2:
+        return np.shape(lat)
+    return (len(lat), len(long))
+
+
+def get_window(xmin, xmax, ymin, ymax, lat, long):
+    """
+    Returns the row and column slices of lat and long spanning the given
+    bounds, padded by one point. For 2d grids, the slices span the cells
+    within the bounds.
+    """
+    if np.ndim(lat) == 2:
+        inside = get_inside(xmin, xmax, ymin, ymax, lat, long)
+        rows = np.nonzero(inside.any(axis=1))[0]
+        cols = np.nonzero(inside.any(axis=0))[0]
+        if len(rows) == 0:
+            return slice(0, 0), slice(0, 0)
+        return slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1)
+    
+    x_lo = max(np.searchsorted(long, xmin) - 1, 0)
+    x_hi = min(np.searchsorted(long, xmax) + 1, len(long))
+    y_lo = max(len(lat) - np.searchsorted(np.flip(lat), ymax) - 1, 0)
+    y_hi = min(len(lat) - np.searchsorted(np.flip(lat), ymin) + 1, len(lat))
+    return slice(y_lo, max(y_lo, y_hi)), slice(x_lo, max(x_lo, x_hi))
+
+
+def get_inside(xmin, xmax, ymin, ymax, lat, long):
+    """
+    Returns a boolean array of the cells of a 2d grid within the bounds.
+    """
+    return (long >= xmin) & (long <= xmax) & (lat >= ymin) & (lat <= ymax)
+
+
+def get_grid(rows, cols, lat, long):
+    """
+    Returns the longitude and latitude of each cell within rows and cols.
+    """
+    if np.ndim(lat) == 2:
+        return long[rows, cols], lat[rows, cols]
+    return np.meshgrid(long[cols], lat[rows])
+
+
+def find_selection_polygon_compact(coords, lat, long):
+    """
+    Compact version of find_selection_polygon, see SelectionMask.
+    """
+    poly = mplPath.Path(coords)
+    rows, cols = get_window(*get_poly_bounds(coords), lat, long)
+
+    x, y = get_grid(rows, cols, lat, long)
+    inside = poly.contains_points(np.column_stack((x.ravel(), y.ravel())))
+
+    return SelectionMask(rows, cols, ~inside.reshape(x.shape))
 
 
 def find_selection_polygon(coords, lat, long):
@@ -8,27 +212,25 @@ def find_selection_polygon(coords, lat, long):
     Finds the coordinates in lat and long enclosed by the polygon defined by
     the coordinates in coords. Returns a mask array that masks points not in
     the selection
-    
+
     Arguments:
     coords ([[int: long, int: lat]]): Array of coordinates of selection polygon.
     lat ([int]): Array of latitude coordinates the selection should be found in.
     long ([int]): Array of longitude coordinates the selection should be found in.
     """
-    poly = mplPath.Path(coords)
-    xmin, xmax, ymin, ymax = get_poly_bounds(coords)
-    x_lo = np.searchsorted(long, xmin) - 1
-    x_hi = np.searchsorted(long, xmax) + 1
-    y_lo = len(lat) - np.searchsorted(np.flip(lat), ymax) - 1
-    y_hi = len(lat) - np.searchsorted(np.flip(lat), ymin) + 1
-    
-    mask = np.full((len(lat), len(long)), True)
-    
-    for y in range(y_lo, y_hi):
-        for x in range(x_lo, x_hi):
-            if poly.contains_point([long[x], lat[y]]):
-                mask[y,x] = False
+    return find_selection_polygon_compact(coords, lat, long).full(grid_shape(lat, long))
 
-    return mask
+
+def find_selection_rectangle_compact(coords, lat, long):
+    """
+    Compact version of find_selection_rectangle, see SelectionMask.
+    """
+    rows, cols = get_window(*get_poly_bounds(coords), lat, long)
+    if np.ndim(lat) == 2:
+        x, y = get_grid(rows, cols, lat, long)
+        return SelectionMask(rows, cols, ~get_inside(*get_poly_bounds(coords), y, x))
+    mask = np.full((rows.stop-rows.start, cols.stop-cols.start), False)
+    return SelectionMask(rows, cols, mask)
 
 
 def find_selection_rectangle(coords, lat, long):
@@ -36,23 +238,37 @@ def find_selection_rectangle(coords, lat, long):
     Finds the coordinates in lat and long enclosed by the rectangle
     defined by the coordinates in coords. Returns a mask array that masks
     points not in the selection.
-    
+
     Arguments:
     coords ([[int: long, int: lat]]): Coordinates of selection rectangle.
     lat ([int]): Array of latitude coordinates the selection should be found in.
     long ([int]): Array of longitude coordinates the selection should be found in.
     """
-    xmin, xmax, ymin, ymax = get_poly_bounds(coords)
-    x_lo = np.searchsorted(long, xmin) - 1
-    x_hi = np.searchsorted(long, xmax) + 1
-    y_lo = len(lat) - np.searchsorted(np.flip(lat), ymax) - 1
-    y_hi = len(lat) - np.searchsorted(np.flip(lat), ymin) + 1
-    
-    mask = np.full((len(lat), len(long)), True)
-    
-    mask[y_lo:y_hi,x_lo:x_hi] = False
-    
-    return mask
+    return find_selection_rectangle_compact(coords, lat, long).full(grid_shape(lat, long))
+
+
+def find_selection_circle_compact(center, radius, lat, long):
+    """
+    Compact version of find_selection_circle, see SelectionMask.
+    """
+    ymin, ymax = get_circle_y_bounds(center, radius)
+    if np.ndim(lat) == 2:
+        rows = np.nonzero(((lat >= ymin) & (lat <= ymax)).any(axis=1))[0]
+        rows = slice(rows[0], rows[-1]+1) if len(rows) else slice(0, 0)
+    else:
+        y_lo = max(len(lat) - np.searchsorted(np.flip(lat), ymax), 0)
+        y_hi = min(len(lat) - np.searchsorted(np.flip(lat), ymin), len(lat))
+        rows = slice(y_lo, max(y_lo, y_hi))
+
+    x, y = get_grid(rows, slice(None), lat, long)
+    inside = distance(center, [x, y]) < radius
+
+    cols = np.nonzero(inside.any(axis=0))[0]
+    if len(cols) == 0:
+        return SelectionMask(slice(0, 0), slice(0, 0), np.full((0, 0), True))
+    cols = slice(cols[0], cols[-1] + 1)
+
+    return SelectionMask(rows, cols, ~inside[:, cols])
 
 
 def find_selection_circle(center, radius, lat, long):
@@ -60,25 +276,14 @@ def find_selection_circle(center, radius, lat, long):
     Finds the coordinates in lat and long enclosed by the circle
     defined by the central coordinate and radius. Returns a mask array
     that masks points not in the selection.
-    
+
     Arguments:
     center ([int: long, int: lat]): Coordinate specifying the center of the circle.
-    radius (float||int): Radius of circle in meters.
+    radius (float||int): Radius of circle in kilometers.
     lat ([int]): Array of latitude coordinates the selection should be found in.
     long ([int]): Array of longitude coordinates the selection should be found in.
     """
-    ymin, ymax = get_circle_y_bounds(center, radius)
-    y_lo = len(lat) - np.searchsorted(np.flip(lat), ymax)
-    y_hi = len(lat) - np.searchsorted(np.flip(lat), ymin) -1
-    
-    mask = np.full((len(lat), len(long)), True)
-    
-    for y in range(y_lo, y_hi):
-        for x in range(len(long)):
-            if distance(center, [long[x], lat[y]]) < radius:
-                mask[y,x] = False
-    
-    return mask
+    return find_selection_circle_compact(center, radius, lat, long).full(grid_shape(lat, long))
 
 
 def get_circle_y_bounds(center, radius):
@@ -87,15 +292,15 @@ def get_circle_y_bounds(center, radius):
     ymax = center[1] + deg
     return ymin, ymax
 
-                
+
 def get_poly_bounds(poly_points):
     xmin = np.min(poly_points[:,0])
     xmax = np.max(poly_points[:,0])
     ymin = np.min(poly_points[:,1])
     ymax = np.max(poly_points[:,1])
     return xmin, xmax, ymin, ymax
-    
-        
+
+
 def is_rectangle(poly_points):
     if len(poly_points) == 5:
         if poly_points[0][0] == poly_points[1][0] and \
@@ -109,33 +314,41 @@ def is_rectangle(poly_points):
 
 def distance(origin, destination):
     """
-    Distance between two coordinates using Haversine formula
+    Distance between two coordinates using Haversine formula. The destination
+    coordinates may be arrays.
     """
     lon1, lat1 = origin
     lon2, lat2 = destination
     radius = 6371    # earth radius in km
 
-    dlat = radians(lat2-lat1)
-    dlon = radians(lon2-lon1)
-    
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a), sqrt(1-a))
+    dlat = np.radians(lat2-lat1)
+    dlon = np.radians(lon2-lon1)
+
+    a = np.sin(dlat/2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
     d = radius * c
 
     return d
 
 
-def find_selection(selection, lat, long):
+def find_selection_compact(selection, lat, long):
     """
-    Determines selection type and returns the selection
+    Determines selection type and returns the compact selection mask
     """
     if selection['geometry']['type'] == 'Point':
-        return find_selection_circle(selection['geometry']['coordinates'],
-                                     selection['properties']['style']['radius']/1000,
-                                     lat, long)
+        return find_selection_circle_compact(selection['geometry']['coordinates'],
+                                             selection['properties']['style']['radius']/1000,
+                                             lat, long)
     elif selection['geometry']['type'] == 'Polygon':
         coords = np.array(selection['geometry']['coordinates'][0])
         if is_rectangle(coords):
-            return find_selection_rectangle(coords, lat, long)
+            return find_selection_rectangle_compact(coords, lat, long)
         else:
-            return find_selection_polygon(coords, lat, long)
+            return find_selection_polygon_compact(coords, lat, long)
+
+
+def find_selection(selection, lat, long):
+    """
+    Determines selection type and returns the selection
+    """
+    return find_selection_compact(selection, lat, long).full(grid_shape(lat, long))
@@ -0,0 +1,329 @@
+import ast
+import numpy as np
+
+
+# Functions available within expressions. Only ufuncs are allowed, so results
+# can be written into preallocated buffers.
+FUNCTIONS = {
+    'sqrt': np.sqrt, 'abs': np.absolute, 'exp': np.exp, 'log': np.log,
+    'log10': np.log10, 'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'arcsin': np.arcsin, 'arccos': np.arccos, 'arctan': np.arctan,
+    'arctan2': np.arctan2, 'hypot': np.hypot, 'minimum': np.minimum,
+    'maximum': np.maximum, 'floor': np.floor, 'ceil': np.ceil,
+}
+
+OPERATORS = {
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+    ast.Div: np.true_divide, ast.Pow: np.power, ast.Mod: np.mod,
+    ast.USub: np.negative, ast.UAdd: np.positive,
+}
+
+
+class VirtualVariable:
+    """
+    Base of variables that are computed when read. Supports the indexing
+    layers use on netCDF variables: an index or slice over time, optionally
+    followed by indices or slices over y and x.
+    """
+    ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        return self.read(key + (slice(None),) * (3 - len(key)))
+
+    def read(self, key):
+        raise NotImplementedError
+
+
+class Expression(VirtualVariable):
+    """
+    Variable derived from an expression over other variables on the same
+    grid, e.g. 'sqrt(u**2 + v**2)'. Only the requested frames and region of
+    the variables are read, and the expression is evaluated on them when
+    read, so the derived variable is never stored. Intermediate results are
+    written into buffers that are reused between reads.
+
+    Variables without time dimension, e.g. a climatology, are broadcast over
+    time.
+    """
+    def __init__(self, expression, variables):
+        """
+        Arguments:
+        expression (string): Expression over variables. Arithmetic operators
+            and the functions in FUNCTIONS are available.
+        variables (dict): Variables by name, either netCDF variables or
+            VirtualVariables. May contain more variables than used.
+        """
+        self.expression = expression
+        self.tree = ast.parse(expression, mode='eval').body
+
+        names = set(n.id for n in ast.walk(self.tree) if isinstance(n, ast.Name))
+        names -= set(FUNCTIONS)
+        for name in names:
+            if name not in variables:
+                raise ValueError(f"Unknown variable '{name}' in expression "
+                                 f"'{expression}'.")
+        self.variables = {name: variables[name] for name in names}
+
+        timed = [n for n in sorted(names) if self.variables[n].ndim == 3]
+        if not timed:
+            raise ValueError(f"Expression '{expression}' has no variable with "
+                             f"a time dimension.")
+        self.reference = timed[0]
+        self.shape = self.variables[self.reference].shape
+
+        for name, var in self.variables.items():
+            if tuple(var.shape[-2:]) != tuple(self.shape[1:]) or \
+                    (var.ndim == 3 and var.shape[0] != self.shape[0]):
+                raise ValueError(f"Variable '{name}' is not on the grid of "
+                                 f"'{self.reference}'.")
+
+        self.buffers = {}
+
+    def chunking(self):
+        var = self.variables[self.reference]
+        return var.chunking() if hasattr(var, 'chunking') else 'contiguous'
+
+    def read(self, key):
+        inputs = {}
+        for name, var in self.variables.items():
+            data = var[key] if var.ndim == 3 else var[key[1:]]
+            dtype = np.result_type(data.dtype, np.float32)
+            inputs[name] = np.ma.filled(np.ma.asarray(data, dtype=dtype), np.nan)
+
+        # The result is handed to the caller, it is never released for reuse.
+        result, owned = self.evaluate(self.tree, inputs)
+        if not owned:
+            result = np.array(result, dtype=np.result_type(result, np.float32))
+        return result
+
+    def buffer(self, shape, dtype):
+        free = self.buffers.setdefault((shape, dtype), [])
+        return free.pop() if free else np.empty(shape, dtype)
+
+    def release(self, array):
+        self.buffers.setdefault((array.shape, array.dtype), []).append(array)
+
+    def apply(self, ufunc, operands):
+        """
+        Applies ufunc, writing the result into an owned operand of the
+        result's shape if there is one, else into a buffer.
+        """
+        arrays = [a for a, _ in operands]
+        shape = np.broadcast(*arrays).shape
+        dtype = np.result_type(*arrays)
+
+        out = None
+        for a, owned in operands:
+            if owned and out is None and a.shape == shape and a.dtype == dtype:
+                out = a
+            elif owned:
+                self.release(a)
+        if out is None:
+            out = self.buffer(shape, dtype)
+
+        ufunc(*arrays, out=out)
+        return out, True
+
+    def evaluate(self, node, inputs):
+        """
+        Evaluates node, returning the result and whether it is held in a
+        buffer that may be overwritten.
+        """
+        if isinstance(node, ast.Name):
+            return inputs[node.id], False
+        elif type(node).__name__ in ('Constant', 'Num'):
+            value = node.value if isinstance(node, ast.Constant) else node.n
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return np.float32(value), False
+        elif isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return self.apply(OPERATORS[type(node.op)],
+                              [self.evaluate(node.left, inputs),
+                               self.evaluate(node.right, inputs)])
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+            return self.apply(OPERATORS[type(node.op)],
+                              [self.evaluate(node.operand, inputs)])
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+                node.func.id in FUNCTIONS and not node.keywords:
+            return self.apply(FUNCTIONS[node.func.id],
+                              [self.evaluate(arg, inputs) for arg in node.args])
+        raise ValueError(f"Unsupported expression '{ast.dump(node)}' in "
+                         f"'{self.expression}'.")
+
+
+def open_variable(datasets, name):
+    """
+    Returns the variable name from the first dataset that has it, or an
+    Expression over the variables of all datasets if name is no variable.
+    Also returns the dataset and name of the variable the grid is read from.
+
+    Arguments:
+    datasets ([netCDF4.Dataset]): Datasets on the same grid, in order of
+        precedence.
+    name (string): Variable name or expression.
+    """
+    for ds in datasets:
+        if name in ds.variables:
+            return ds[name], ds, name
+
+    variables = {}
+    origin = {}
+    for ds in reversed(datasets):
+        variables.update(ds.variables)
+        origin.update({n: ds for n in ds.variables})
+
+    expression = Expression(name, variables)
+    return expression, origin[expression.reference], expression.reference
+
+
+# Keys grouping times into calendar periods.
+PERIODS = {
+    'hour': lambda t: (t.year, t.month, t.day, t.hour),
+    'day': lambda t: (t.year, t.month, t.day),
+    'month': lambda t: (t.year, t.month),
+    'year': lambda t: (t.year,),
+}
+
+
+def time_chunk(variable, default=24):
+    """
+    Returns the number of frames variable is best read with at once.
+    """
+    chunking = variable.chunking() if hasattr(variable, 'chunking') else 'contiguous'
+    return chunking[0] if chunking != 'contiguous' else default
+
+
+def running_sum(block, total=None, count=None, sign=1):
+    """
+    Adds (or with sign -1 subtracts) the sum over time of the valid values in
+    block to total, and their number to count.
+    """
+    block = np.ma.filled(np.ma.asarray(block, dtype=np.float64), np.nan)
+    valid = np.isfinite(block)
+    s = np.where(valid, block, 0).sum(axis=0)
+    c = valid.sum(axis=0)
+    if total is None:
+        return s, c
+    total += sign * s
+    count += sign * c
+    return total, count
+
+
+def mean(total, count):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan).astype(np.float32)
+
+
+class Resample(VirtualVariable):
+    """
+    Means of a variable over calendar periods, e.g. daily means of hourly
+    data. The frames of a period are read one time chunk at a time and
+    summed into a running sum, so a period is never held in memory at once.
+    """
+    def __init__(self, variable, time, period):
+        """
+        Arguments:
+        variable ([time:y:x]): Variable to be resampled.
+        time ([datetime]): Times of the frames of variable, in order.
+        period (string): One of 'hour', 'day', 'month' and 'year'.
+        """
+        if period not in PERIODS:
+            raise ValueError(f"Unknown period '{period}', expected one of "
+                             f"{', '.join(PERIODS)}.")
+        self.variable = variable
+        self.chunk = time_chunk(variable)
+
+        keys = [PERIODS[period](t) for t in time]
+        starts = [i for i in range(len(keys)) if i == 0 or keys[i] != keys[i-1]]
+        self.groups = list(zip(starts, starts[1:] + [len(keys)]))
+        self.time = [time[start] for start, _ in self.groups]
+        self.shape = (len(self.groups),) + tuple(variable.shape[1:])
+
+    def chunking(self):
+        return 'contiguous'
+
+    def read(self, key):
+        time, space = key[0], key[1:]
+        if not isinstance(time, slice):
+            return self.mean(time, space)
+        return np.stack([self.mean(i, space) for i in range(len(self))[time]])
+
+    def mean(self, i, space):
+        start, stop = self.groups[i]
+        total = count = None
+        for t in range(start, stop, self.chunk):
+            block = self.variable[(slice(t, min(t + self.chunk, stop)),) + space]
+            total, count = running_sum(block, total, count)
+        return mean(total, count)
+
+
+class Rolling(VirtualVariable):
+    """
+    Rolling mean of a variable over the window frames up to and including
+    each frame. The first frames average over the frames available. When
+    frames are read in order, the running sum is updated incrementally by
+    adding the new frame and subtracting the one leaving the window.
+    """
+    def __init__(self, variable, window):
+        """
+        Arguments:
+        variable ([time:y:x]): Variable to be averaged.
+        window (int): Number of frames averaged.
+        """
+        self.variable = variable
+        self.window = window
+        self.shape = tuple(variable.shape)
+        self.state = None
+
+    def chunking(self):
+        return 'contiguous'
+
+    def read(self, key):
+        time, space = key[0], key[1:]
+        if not isinstance(time, slice):
+            return self.mean(time, space)
+        return np.stack([self.mean(i, space) for i in range(len(self))[time]])
+
+    def mean(self, i, space):
+        if self.state is not None and self.state[0] == i - 1 and \
+                self.state[1] == space:
+            _, _, total, count = self.state
+            total, count = running_sum(self.variable[(slice(i, i+1),) + space],
+                                       total, count)
+            if i - self.window >= 0:
+                old = self.variable[(slice(i - self.window, i - self.window + 1),) + space]
+                total, count = running_sum(old, total, count, sign=-1)
+        else:
+            start = max(i - self.window + 1, 0)
+            total, count = running_sum(self.variable[(slice(start, i+1),) + space])
+
+        self.state = (i, space, total, count)
+        return mean(total, count)
+
+
+def aggregate(variable, time, resample=None, rolling=None):
+    """
+    Returns variable resampled to periods and/or as rolling mean, together
+    with the times of its frames. See Resample and Rolling.
+    """
+    if resample:
+        variable = Resample(variable, time, resample)
+        time = variable.time
+    if rolling:
+        variable = Rolling(variable, rolling)
+    return variable, time
+
+
+def aggregate_name(name, resample=None, rolling=None):
+    """
+    Returns the name of variable name after aggregate.
+    """
+    if resample:
+        name += f".{resample}"
+    if rolling:
+        name += f".rolling{rolling}"
+    return name
@@ -1,59 +1,133 @@
+import os
+import shutil
+import hashlib
+import threading
+from urllib.parse import quote
+from datetime import datetime
+import numpy as np
+import matplotlib.pyplot as plt
 from ipyleaflet import *
 from ipywidgets import *
 
 from .layer import *
 from .selection import *
+from .renderer import *
 
 basemaps = basemaps # ipyleaflet's basemaps
 
+def plot_times(time):
+    """
+    Returns the times of a layer as datetimes matplotlib can plot. Times of
+    calendars without datetime equivalent, e.g. 360 day calendars, are
+    returned as their labels.
+    """
+    try:
+        return [datetime(t.year, t.month, t.day, t.hour, t.minute, t.second)
+                for t in time]
+    except ValueError:
+        return [str(t) for t in time]
+
+
+def served_url(path):
+    """
+    Returns the URL the Jupyter server serves the file at path from. path is
+    relative to the working directory of the kernel, the directory of the
+    notebook.
+    """
+    base = os.environ.get('JUPYTERHUB_SERVICE_PREFIX', '/')
+    # Path of the notebook within the served directory, set by jupyter_server.
+    notebook = os.environ.get('JPY_SESSION_NAME', '')
+    if os.path.isabs(notebook):
+        notebook = ''
+    path = os.path.normpath(os.path.join(os.path.dirname(notebook), path))
+    return f"{base.rstrip('/')}/files/{quote(path.replace(os.sep, '/'))}"
+
+
 class VizMap:
     #def __init__(self, basemap=basemaps.OpenStreetMap.Mapnik, center=(0,0), zoom=1):
     #    self.map = Map(basemap=basemap, center=center, zoom=zoom)
-    def __init__(self, **kwargs):
+    def __init__(self, renderer=None, play_box=None, **kwargs):
+        """
+        Arguments:
+        renderer (Renderer): Render engine shared by the layers of the map,
+            and with other maps if given, see LinkedMaps.
+        play_box (HBox): Play controls shared with another map, see
+            get_play_box. The map gets play controls of its own if None.
+        **kwargs: See ipyleaflet's Map.
+        """
         self.map = Map(**kwargs)
         self.layers = []
         self.selections = []
+        self.videos = {}
+        self.renderer = renderer if renderer is not None else Renderer()
         
         # initialize widgets
-        play = Play(
-            value=0,
-            min=0,
-            max=100,
-            step=1,
-            interval=50,
-            description="Play",
-        )
+        shared = play_box is not None
+        if not shared:
+            play_box = self.get_play_box()
+        play = play_box.children[2]
         
-        fps_text = IntText(
-            value=20,
-            disabled=False,
-        )
-        fps_text.layout.max_width = '50px'
+        def playing_update(change):
+            for layer in self.layers:
+                if change['new']:
+                    self.start_video(layer)
+                elif layer.video_playing:
+                    self.stop_video(layer)
         
-        def fps_update(change):
-            play.interval = 1000 / change['new']
+        def play_update(change):
+            for layer in self.layers:
+                if layer.video_playing and \
+                        not layer.video[1] <= change['new'] < layer.video[2]:
+                    self.stop_video(layer, min(change['new'], len(layer)-1))
         
-        fps_text.observe(fps_update, 'value')
+        def interval_update(change):
+            # Videos play at the rate they were encoded with.
+            for layer in self.layers:
+                if layer.video_playing and \
+                        abs(1000 / change['new'] - layer.video[3]) > 1e-3:
+                    self.stop_video(layer)
+        
+        # ipywidgets 7 names the trait '_playing', ipywidgets 8 'playing'.
+        play.observe(playing_update, [n for n in ('playing', '_playing')
+                                      if play.has_trait(n)])
+        play.observe(play_update, 'value')
+        play.observe(interval_update, 'interval')
         
-        play_box = HBox([HTML('FPS'), fps_text, play])
         play_control = WidgetControl(widget=play_box, position='bottomleft')
         self.play_control = play_control
 
         draw_control = self.get_draw_control()
 
         def handle_draw(_self, action, geo_json):
+            previous = list(self.selections)
             if action == 'created':
                 self.selections.append(geo_json)
-            else:
-                self.selections.remove(geo_json)
+            elif action == 'deleted':
+                if geo_json in self.selections:
+                    self.selections.remove(geo_json)
+                invalidate_selection(geo_json)
+            prune_selections(self.selections, previous)
+
+        def data_update(change):
+            # Edits are handled here: the draw control may report an edit
+            # before its data holds the edited geometries.
+            old, new = change['old'] or [], change['new'] or []
+            if len(old) != len(new):
+                return
+            for before, after in zip(old, new):
+                if selection_key(before) != selection_key(after):
+                    self.replace_edited(before, after)
 
         draw_control.on_draw(handle_draw)
+        draw_control.observe(data_update, 'data')
         
         layers = LayersControl(position='topleft')
         
-        self.map.add_control(play_control)
+        if not shared:
+            self.map.add_control(play_control)
         self.map.add_control(layers)
         self.map.add_control(draw_control)
+        self.draw_control = draw_control
 
         
     def add_raster(self, *args, **kwargs):
@@ -63,6 +137,7 @@ class VizMap:
         Arguments:
         See RasterLayer
         """
+        kwargs.setdefault('renderer', self.renderer)
         layer = RasterLayer(*args, **kwargs, name=str(len(self.layers)))
         
         self.layers.append(layer)
@@ -85,6 +160,7 @@ class VizMap:
         Arguments:
         See WindLayer
         """
+        kwargs.setdefault('renderer', self.renderer)
         layer = WindLayer(*args, **kwargs, name=str(len(self.layers)))
         
         if len(layer.u) > self.play_control.widget.children[2].max:
@@ -97,7 +173,174 @@ class VizMap:
         self.map.add_layer(layer.layer_obj)
         self.map.add_control(layer.frame_control)
         
+        if layer.arrows:
+            self.map.observe(layer.update_view, 'bounds')
+        
+        
+    def enable_video(self, layer=0, start=0, stop=None, directory='vizmap_videos',
+                     url=None):
+        """
+        Encodes frames start to stop of a layer into a video file in the
+        background. While playing within these frames, the video is shown
+        from the current frame on instead of the frames, so playback runs in
+        the browser without rendering or sending frames. The video is only
+        shown at the frames per second it was encoded with. Pausing shows the
+        current frame again for scrubbing and selections. Requires ffmpeg.
+        Not available for 'geojson' wind layers. If encoding fails, the
+        exception is kept in the video_error of the layer.
+        
+        Arguments:
+        layer (int): Index of layer to be encoded.
+        start (int): First frame of the video.
+        stop (int): Frame the video stops before. The last frame if None.
+        directory (string): Directory the video is written to, within the
+            directory served by the Jupyter server.
+        url (string): URL the browser loads the video from. By default the
+            URL the Jupyter server serves the video file at, see served_url.
+        """
+        layer = self.layers[layer]
+        if getattr(layer, 'method', None) == 'geojson':
+            raise ValueError("Video is not available for the 'geojson' method.")
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError("Encoding video requires ffmpeg.")
+        
+        play = self.play_control.widget.children[2]
+        fps = 1000 / play.interval
+        os.makedirs(directory, exist_ok=True)
+        name = hashlib.sha1(f"{layer.key}:{start}:{stop}:{fps}".encode()).hexdigest()
+        path = os.path.join(directory, f"{name[:16]}.webm")
+        
+        def prepare():
+            try:
+                layer.prepare_video(start, stop, fps, path, url or served_url(path))
+            except Exception:
+                pass    # Kept in layer.video_error.
+        
+        thread = threading.Thread(target=prepare, daemon=True)
+        thread.start()
+        return thread
+    
+    
+    def start_video(self, layer):
+        """
+        Shows the video of a layer instead of its frames, from its current
+        frame on, if the video is encoded, contains the current frame and
+        frames play at the rate it was encoded with.
+        """
+        if layer.video is None or layer.video_playing:
+            return
+        url, start, stop, fps = layer.video
+        play = self.play_control.widget.children[2]
+        if not start <= layer.frame < stop or \
+                abs(1000 / play.interval - fps) > 1e-3:
+            return
+        
+        # Media fragment starting the video at the current frame. The video
+        # is loaded from its file, only the URL is sent.
+        overlay = VideoOverlay(url=f"{url}#t={(layer.frame-start)/fps:.3f}",
+                               bounds=layer.layer_obj.bounds,
+                               name=layer.layer_obj.name)
+        self.videos[layer] = overlay
+        layer.video_playing = True
+        self.map.remove_layer(layer.layer_obj)
+        self.map.add_layer(overlay)
+    
+    
+    def stop_video(self, layer, frame=None):
+        """
+        Shows the frames of a layer again instead of its video, at frame or
+        the current frame.
+        """
+        overlay = self.videos.pop(layer)
+        layer.video_playing = False
+        self.map.remove_layer(overlay)
+        self.map.add_layer(layer.layer_obj)
+        layer.update_frame(layer.frame if frame is None else frame)
+    
+    
+    def probe(self, lat, long, layer=0, radius=0):
+        """
+        Returns the time series of a layer at a point, see Layer.probe.
+        
+        Arguments:
+        lat (float): Latitude of point.
+        long (float): Longitude of point.
+        layer (int): Index of layer to be probed.
+        radius (int): Radius in grid cells of neighborhood to be probed.
+        """
+        return self.layers[layer].probe(lat, long, radius)
+    
+    
+    def enable_probe(self, layer=0, radius=0):
+        """
+        Plots the time series of a layer at the point clicked on the map. For
+        radius larger than 0, the mean of the neighborhood is plotted. The
+        last probed series is kept in probed as (lat, long, series).
+        
+        Arguments:
+        layer (int): Index of layer to be probed.
+        radius (int): Radius in grid cells of neighborhood to be probed.
+        """
+        output = Output()
+        probe_control = WidgetControl(widget=output, position='topright')
+        
+        def handle_interaction(**kwargs):
+            if kwargs.get('type') != 'click':
+                return
+            lat, long = kwargs['coordinates']
+            series = self.probe(lat, long, layer, radius)
+            if series is None:
+                return
+            self.probed = (lat, long, series)
+            
+            if not isinstance(series, tuple):
+                series = (series,)
+            
+            times = plot_times(self.layers[layer].time)
+            
+            with output:
+                output.clear_output(wait=True)
+                fig, ax = plt.subplots(figsize=(5, 2.5))
+                for s in series:
+                    ax.plot(times, s if radius == 0 else np.nanmean(s, axis=(1, 2)))
+                ax.set_title(f"{lat:.3f}, {long:.3f}")
+                ax.set_xlabel('Time')
+                fig.autofmt_xdate()
+                plt.show()
+        
+        self.map.on_interaction(handle_interaction)
+        self.map.add_control(probe_control)
+        self.probe_control = probe_control
+    
+    
+    def get_play_box(self):
+        """
+        Returns the play controls: frames per second and the Play widget
+        frames of all layers are linked to.
+        """
+        play = Play(
+            value=0,
+            min=0,
+            max=100,
+            step=1,
+            interval=50,
+            description="Play",
+        )
         
+        fps_text = IntText(
+            value=20,
+            disabled=False,
+        )
+        fps_text.layout.max_width = '50px'
+        
+        def fps_update(change):
+            play.interval = 1000 / change['new']
+        
+        fps_text.observe(fps_update, 'value')
+        
+        return HBox([HTML('FPS'), fps_text, play])
+    
+    
     def get_draw_control(self):
         draw_control = DrawControl()
 
@@ -124,16 +367,35 @@ class VizMap:
         return draw_control
     
     
+    def replace_edited(self, before, after):
+        """
+        Replaces the selection with the geometry of before by after, the
+        selection it was edited into, and removes the cached masks of before.
+        """
+        key = selection_key(before)
+        for i, selection in enumerate(self.selections):
+            if selection_key(selection) == key:
+                self.selections[i] = after
+                break
+        else:
+            self.selections.append(after)
+        invalidate_selection(before)
+        
+        
     def remove_layer(self, layer):
         """
         Arguments:
         layer (int): Index of layer to be removed. Should be their name within
             the layer control widget.
         """
+        if self.layers[layer].video_playing:
+            self.stop_video(self.layers[layer])
         self.map.remove_layer(self.layers[layer].layer_obj)
         self.map.remove_control(self.layers[layer].frame_control)
         if type(self.layers[layer]) == RasterLayer:
             self.map.remove_control(self.layers[layer].opacity_control)
+        elif self.layers[layer].arrows:
+            self.map.unobserve(self.layers[layer].update_view, 'bounds')
             
         self.layers.pop(layer)
         
@@ -149,7 +411,8 @@ class VizMap:
         
     def get_selection(self, selection, layer=0):
         """
-        Get one or multiple selections from a layer.
+        Get one or multiple selections from a layer. The result is cropped to
+        the bounding box of the selection(s), see SelectionMask.
         
         Arguments:
         selection (int||[int]): Index/indices of selection(s) to be retrieved.
@@ -171,4 +434,76 @@ class VizMap:
     
     def _repr_html_(self):
         return display(self.map)
+
+
+class LinkedMaps:
+    """
+    Maps side by side with synchronized pan, zoom and time, e.g. to compare
+    model runs or variables. The maps share one renderer, so their layers
+    render in one process pool, open each dataset once and share the frames
+    of layers showing the same data, see Renderer. The first map holds the
+    play controls of all maps.
+    """
+    def __init__(self, n=2, columns=None, renderer=None, **kwargs):
+        """
+        Arguments:
+        n (int): Number of maps.
+        columns (int): Number of maps per row. All maps are in one row if None.
+        renderer (Renderer): Render engine of the maps. Created if None.
+        **kwargs: See ipyleaflet's Map.
+        """
+        self.renderer = renderer if renderer is not None else Renderer()
+        first = VizMap(renderer=self.renderer, **kwargs)
+        self.maps = [first] + [VizMap(renderer=self.renderer,
+                                      play_box=first.play_control.widget,
+                                      **kwargs) for i in range(n-1)]
+        
+        for m in self.maps[1:]:
+            jslink((first.map, 'center'), (m.map, 'center'))
+            jslink((first.map, 'zoom'), (m.map, 'zoom'))
+        
+        columns = columns or n
+        self.box = GridBox([m.map for m in self.maps],
+                           layout=Layout(grid_template_columns=f"repeat({columns}, 1fr)"))
+        
+        
+    def __getitem__(self, i):
+        return self.maps[i]
     
+    
+    def __len__(self):
+        return len(self.maps)
+        
+        
+    def add_raster(self, map, *args, **kwargs):
+        """
+        Add a regular raster vizualisation layer to a map.
+        
+        Arguments:
+        map (int): Index of map the layer is added to.
+        See RasterLayer
+        """
+        self.maps[map].add_raster(*args, **kwargs)
+        
+        
+    def add_wind(self, map, *args, **kwargs):
+        """
+        Add a wind vizualisation layer to a map.
+        
+        Arguments:
+        map (int): Index of map the layer is added to.
+        See WindLayer
+        """
+        self.maps[map].add_wind(*args, **kwargs)
+        
+        
+    def clear_maps(self):
+        for m in self.maps:
+            m.clear_map()
+        
+        
+    def display(self):
+        display(self.box)
+        
+    def _repr_html_(self):
+        return display(self.box)
@@ -0,0 +1,128 @@
+"""
+Pre-renders the frames of a layer into a frame cache directory, without a
+notebook. Layers created with the same arguments and cache_dir then load
+their frames from the cache. Interrupted runs resume where they stopped.
+
+Usage:
+    python -m vizmap.warmup raster data.nc t2m --cache-dir cache --cmap magma
+    python -m vizmap.warmup wind data.nc --u u10 --v v10 --stride 4 \\
+        --method quiver --cache-dir cache --start 0 --stop 240
+"""
+import sys
+import time
+import argparse
+from multiprocessing import Pool, cpu_count
+
+from .layer import RasterLayer, WindLayer, calc_frame
+
+
+def render(args):
+    return calc_frame(*args)
+
+
+def warmup(layer, start=0, stop=None, processes=cpu_count(), chunk=None,
+           out=sys.stdout):
+    """
+    Renders the uncached frames from start to stop of a layer into its frame
+    cache, printing progress and throughput.
+
+    Arguments:
+    layer (RasterLayer||WindLayer): Layer created with a cache_dir.
+    start (int): First frame rendered.
+    stop (int): Frame rendering stops before. The last frame if None.
+    processes (int): Number of render processes.
+    chunk (int): Number of frames read from the dataset at once. Defaults to
+        four frames per process.
+    out (file): Stream progress is printed to.
+    """
+    if layer.frame_cache is None:
+        raise ValueError("Layer has no frame cache, create it with cache_dir.")
+
+    stop = len(layer) if stop is None else min(stop, len(layer))
+    chunk = chunk or 4 * processes
+    todo = [i for i in range(start, stop) if i not in layer.frame_cache]
+    total = len(todo)
+    print(f"{layer.frame_cache.path}: {stop-start-total} of {stop-start} "
+          f"frames cached, rendering {total}", file=out)
+
+    done = 0
+    t0 = time.time()
+    with Pool(processes=processes) as pool:
+        for c in range(0, total, chunk):
+            frames = todo[c:c+chunk]
+            first = frames[0]
+            args = [a for a in layer.render_args(first, frames[-1]-first+1)
+                    if a[0] not in layer.frame_cache]
+
+            for frame, i in pool.imap_unordered(render, args):
+                layer.frame_cache.put(i, frame)
+                done += 1
+
+            elapsed = time.time() - t0
+            print(f"{done}/{total} frames, {done/elapsed:.1f} frames/s",
+                  file=out, flush=True)
+
+    return done
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m vizmap.warmup',
+        description="Pre-render layer frames into a frame cache directory.")
+    subparsers = parser.add_subparsers(dest='layer')
+    subparsers.required = True
+
+    raster = subparsers.add_parser('raster', help="See RasterLayer.")
+    raster.add_argument('file')
+    raster.add_argument('data')
+
+    wind = subparsers.add_parser('wind', help="See WindLayer.")
+    wind.add_argument('file')
+    wind.add_argument('--u', default='u')
+    wind.add_argument('--v', default='v')
+    wind.add_argument('--stride', type=int, default=1)
+    wind.add_argument('--method', default='geojson', choices=['geojson', 'quiver'])
+    wind.add_argument('--no-autoscale', dest='autoscale', action='store_false')
+    wind.add_argument('--color', action='store_true')
+    wind.add_argument('--scale-value', type=float, default=0.5)
+    wind.add_argument('--compact', action='store_true')
+    wind.add_argument('--precision', type=int, default=3)
+
+    for p in (raster, wind):
+        p.add_argument('--cache-dir', required=True)
+        p.add_argument('--time', default='time')
+        p.add_argument('--lat', default='latitude')
+        p.add_argument('--long', default='longitude')
+        p.add_argument('--cmap', default='viridis')
+        p.add_argument('--files', nargs='*', default=())
+        p.add_argument('--resample', choices=['hour', 'day', 'month', 'year'])
+        p.add_argument('--rolling', type=int)
+        p.add_argument('--memmap', action='store_true')
+        p.add_argument('--start', type=int, default=0)
+        p.add_argument('--stop', type=int, default=None)
+        p.add_argument('--processes', type=int, default=cpu_count())
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    kwargs = dict(time=args.time, lat=args.lat, long=args.long,
+                  cmap=args.cmap, files=args.files, resample=args.resample,
+                  rolling=args.rolling, memmap=args.memmap,
+                  cache_dir=args.cache_dir, interactive=False)
+
+    if args.layer == 'raster':
+        layer = RasterLayer(args.file, args.data, **kwargs)
+    else:
+        layer = WindLayer(args.file, args.u, args.v, stride=args.stride,
+                          method=args.method, autoscale=args.autoscale,
+                          color=args.color, scale_value=args.scale_value,
+                          compact=args.compact, precision=args.precision,
+                          **kwargs)
+
+    warmup(layer, args.start, args.stop, args.processes)
+
+
+if __name__ == '__main__':
+    main()